@@ -2,6 +2,7 @@
 
 from cStringIO import StringIO
 
+import __builtin__
 import cProfile
 try:
     import pstats
@@ -11,25 +12,81 @@ except ImportError:
     # from a local copy
     import _pstats as pstats
 
+import copy
 import gc
 import hashlib
+import itertools
+import sys
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
 import time
+import timeit
 import traceback
+import types
 import inspect
 
+import numpy as np
+
 # from pandas.util.testing import set_trace
 
 
 class Benchmark(object):
+    """
+    Parameters
+    ----------
+    repeat : int
+        number of repeats of the timing loop (at least, if target_precision
+        is set)
+    target_precision : float or None
+        keep repeating until the 95% confidence interval of the median time
+        is narrower than +-target_precision relative to it (e.g. 0.01), or
+        time_budget is used up
+    time_budget : float
+        seconds which may be spent on timing when target_precision is set
+    memory : boolean
+        before timing, execute code once measuring the increase of the
+        peak resident set size and, if tracemalloc is available, the net and
+        peak number of bytes allocated (see measure_memory).  As peak RSS
+        depends on what ran before in the process, BenchmarkRunner runs
+        such benchmarks in a process of their own
+    timer : string or None
+        one of TIMERS to measure time with: 'wall' (default), 'process' or
+        'thread' CPU time, or 'perf_counter', a monotonic high resolution
+        clock (CLOCK_MONOTONIC_RAW, on Linux only).  If None, the default
+        of the runner (BenchmarkRunner(timer=...)) applies
+    params : dict or None
+        parameter name -> list of values.  The benchmark is then run for
+        every combination of values, bound to the names before setup, each
+        one being stored as a separate benchmark (see instances).  Use
+        complexity to fit how timings scale with a numeric parameter
+    share_setup : boolean, default: True
+        benchmarks with identical setup and cleanup (see setup_checksum)
+        may run in shallow copies of one namespace set up just once.
+        Disable for benchmarks which mutate objects created by setup
+    """
 
     def __init__(self, code, setup, ncalls=None, repeat=3, cleanup=None,
                  name=None, module_name=None, description=None, start_date=None,
-                 logy=False):
+                 logy=False, target_precision=None, time_budget=10.,
+                 memory=False, timer=None, params=None, share_setup=True):
         self.code = code
         self.setup = setup
         self.cleanup = cleanup or ''
         self.ncalls = ncalls
         self.repeat = repeat
+        self.target_precision = target_precision
+        self.time_budget = time_budget
+        self.memory = memory
+        self.timer = timer
+        self.params = params
+        self.share_setup = share_setup
+        # for instances of a parameterized benchmark: their parameter
+        # values and the checksum of the benchmark they came from
+        self.param = None
+        self.parent = None
 
         if name is None:
             try:
@@ -59,6 +116,32 @@ class Benchmark(object):
     def checksum(self):
         return hashlib.md5(self.setup + self.code + self.cleanup).hexdigest()
 
+    @property
+    def setup_checksum(self):
+        return hashlib.md5(self.setup + '\0' + self.cleanup).hexdigest()
+
+    def instances(self):
+        """
+        Benchmarks to run: one for every combination of params (names
+        sorted), or just this benchmark if it has no params
+        """
+        if not self.params:
+            return [self]
+        names = sorted(self.params)
+        instances = []
+        for values in itertools.product(*[self.params[n] for n in names]):
+            bm = copy.copy(self)
+            bm.params = None
+            bm.param = dict(zip(names, values))
+            bm.parent = self.checksum
+            bm.setup = ''.join('%s = %r\n' % (n, v)
+                               for n, v in zip(names, values)) + self.setup
+            bm.name = '%s(%s)' % (self.name,
+                                  ', '.join('%s=%r' % (n, v)
+                                            for n, v in zip(names, values)))
+            instances.append(bm)
+        return instances
+
     def profile(self, ncalls):
         prof = cProfile.Profile()
         ns = self._setup()
@@ -74,20 +157,223 @@ class Benchmark(object):
 
         return pstats.Stats(prof).sort_stats('cumulative')
 
-    def get_results(self, db_path):
+    def sample(self, duration=1., interval=0.001, root=None):
+        """
+        Run setup, then sample stacks of executing code for duration
+        seconds, see sampling.sample
+        """
+        from vbench.sampling import sample
+        ns = self._setup()
+        try:
+            return sample(ns, self.code, duration=duration,
+                          interval=interval, root=root)
+        finally:
+            self._cleanup(ns)
+
+    def get_stacks(self, db_path, revision):
+        """
+        Collapsed stacks sampled at revision (see
+        BenchmarkRunner(sample=...)) as text for flamegraph.pl, or None
+        """
+        from vbench.db import BenchmarkDB
+        from vbench.sampling import format_collapsed
+        db = BenchmarkDB.get_instance(db_path)
+        stacks = db.get_stacks(self.checksum, revision)
+        if stacks is None:
+            return None
+        return format_collapsed(stacks)
+
+    def stacks_diff(self, db_path, before, after, normalize=True):
+        """
+        Stacks sampled at revisions before and after as input for a
+        differential flame graph (flamegraph.pl), see
+        sampling.diff_collapsed
+        """
+        from vbench.db import BenchmarkDB
+        from vbench.sampling import diff_collapsed
+        db = BenchmarkDB.get_instance(db_path)
+        stacks = []
+        for rev in (before, after):
+            rev_stacks = db.get_stacks(self.checksum, rev)
+            if rev_stacks is None:
+                raise ValueError('%s was not sampled at revision %s'
+                                 % (self, rev))
+            stacks.append(rev_stacks)
+        return diff_collapsed(stacks[0], stacks[1], normalize=normalize)
+
+    def get_profile(self, db_path, revision):
+        """
+        pstats.Stats of the profile stored at revision (see
+        BenchmarkRunner(profile=True)), or None.  Times are totals over as
+        many calls as a timing repeat made
+        """
+        from vbench.db import BenchmarkDB
+        db = BenchmarkDB.get_instance(db_path)
+        profile = db.get_profile(self.checksum, revision)
+        if profile is None:
+            return None
+        return pstats.Stats(_StoredStats(profile[1])).sort_stats('cumulative')
+
+    def profile_diff(self, db_path, before, after):
+        """
+        Compare the profiles stored at revisions before and after, see
+        profile_diff
+        """
         from vbench.db import BenchmarkDB
         db = BenchmarkDB.get_instance(db_path)
-        return db.get_benchmark_results(self.checksum)
+        profiles = []
+        for rev in (before, after):
+            profile = db.get_profile(self.checksum, rev)
+            if profile is None:
+                raise ValueError('%s was not profiled at revision %s'
+                                 % (self, rev))
+            profiles.append(profile)
+        return profile_diff(*profiles)
+
+    def trace(self):
+        """
+        Run setup and code once, returning the set of files containing the
+        Python code which got executed.  Module level code only executes on
+        the first import in a process, so the files of all modules setup and
+        code import (and of their parent packages) are included, whether or
+        not they were imported already, as are those of modules bound in the
+        namespace or defining its functions and classes.
+        """
+        files = set()
+        modules = set()
+
+        def tracer(frame, event, arg):
+            if event == 'call':
+                files.add(frame.f_code.co_filename)
+
+        def recording_import(name, globals=None, locals=None, fromlist=None,
+                             level=-1):
+            module = real_import(name, globals, locals, fromlist, level)
+            modules.update(_imported_modules(module, name, fromlist))
+            return module
 
-    def run(self):
         ns = None
+        real_import = __builtin__.__import__
+        __builtin__.__import__ = recording_import
+        sys.setprofile(tracer)
         try:
-            stage = 'setup'
             ns = self._setup()
+            exec self.code in ns
+        finally:
+            sys.setprofile(None)
+            __builtin__.__import__ = real_import
+            files.update(path for path in map(_module_file, modules)
+                         if path is not None)
+            if ns:
+                files.update(_namespace_files(ns))
+                self._cleanup(ns)
+        return files
+
+    def get_results(self, db_path, extra=(), normalize=False):
+        """
+        normalize : boolean
+          timings normalized by the reference benchmark, see
+          BenchmarkDB.get_benchmark_results
+        """
+        from vbench.db import BenchmarkDB
+        db = BenchmarkDB.get_instance(db_path)
+        return db.get_benchmark_results(self.checksum, extra=extra,
+                                        normalize=normalize)
+
+    def get_param_results(self, db_path, column='timing', normalize=False):
+        """
+        DataFrame of results (timing by default) of all instances, indexed
+        by timestamp, with a column per instance named by its parameter
+        value (tuple of values for several params)
+        """
+        from pandas import concat
+        extra = [column] if column != 'timing' else []
+        keys, series = [], []
+        for bm in self.instances():
+            key = tuple(bm.param[n] for n in sorted(bm.param))
+            keys.append(key[0] if len(key) == 1 else key)
+            series.append(bm.get_results(db_path, extra=extra,
+                                         normalize=normalize)[column])
+        # aligned on the union of the instances' timestamps
+        frame = concat(series, axis=1)
+        frame.columns = keys
+        return frame
+
+    def complexity(self, db_path, param=None, normalize=False):
+        """
+        Empirical complexity exponent at every revision: slope of log
+        timing (normalized by the reference benchmark if normalize)
+        against log of the numeric parameter `param` (the only parameter
+        by default), see fit_complexity.  Other parameters only shift the
+        intercept.
+
+        Returns a DataFrame indexed by timestamp, with columns revision and
+        exponent.
+        """
+        from pandas import DataFrame
+        names = sorted(self.params or {})
+        if param is None:
+            if len(names) != 1:
+                raise ValueError('Specify which of the params %s to fit the '
+                                 'complexity for' % names)
+            param = names[0]
+        elif param not in names:
+            raise ValueError('%s is not a parameter of %s' % (param, self))
+
+        points = {}
+        revisions = {}
+        for bm in self.instances():
+            others = tuple(bm.param[n] for n in names if n != param)
+            results = bm.get_results(db_path, normalize=normalize)
+            for timestamp, row in results.iterrows():
+                revisions[timestamp] = row['revision']
+                points.setdefault(timestamp, []).append(
+                    (bm.param[param], row['timing'], others))
+
+        rows = []
+        for timestamp in sorted(points):
+            sizes, timings, groups = zip(*points[timestamp])
+            rows.append((timestamp, revisions[timestamp],
+                         fit_complexity(sizes, timings, groups)))
+        return DataFrame.from_records(
+            rows, columns=['timestamp', 'revision', 'exponent'],
+            index='timestamp')
+
+    def run(self, calibration=None, timer=None, ns=None, collect=False):
+        """
+        calibration : tuple or None
+          (loops, seconds per call) from an earlier calibration of the
+          number of loops, see magic_timeit
+        timer : string or None
+          timer to use unless the benchmark chose one itself
+        ns : dict or None
+          namespace with setup already run in (see share_setup).  The
+          benchmark runs in a shallow copy of it, and cleanup is left to
+          the caller
+        collect : boolean
+          collect garbage before measuring memory and timing, see
+          measure_memory and magic_timeit
+        """
+        timer = self.timer or timer or 'wall'
+        shared = ns is not None
+        try:
+            stage = 'setup'
+            ns = dict(ns) if shared else self._setup()
+
+            # before timing, which would already have raised the peak RSS
+            memory = {}
+            if self.memory:
+                stage = 'memory'
+                memory = measure_memory(ns, self.code, collect=collect)
 
             stage = 'benchmark'
             result = magic_timeit(ns, self.code, ncalls=self.ncalls,
-                                  repeat=self.repeat, force_ms=True)
+                                  repeat=self.repeat, force_ms=True,
+                                  calibration=calibration,
+                                  target_precision=self.target_precision,
+                                  time_budget=self.time_budget,
+                                  timer=timer, collect=collect)
+            result.update(memory)
             result['succeeded'] = True
         except:
             buf = StringIO()
@@ -96,7 +382,7 @@ class Benchmark(object):
                       'stage': stage,
                       'traceback': buf.getvalue()}
 
-        if ns:
+        if ns and not shared:
             self._cleanup(ns)
         return result
 
@@ -104,20 +390,22 @@ class Benchmark(object):
         if ncalls is None:
             ncalls = self.ncalls
         code = self.code
+        timefunc = get_timer(self.timer or 'wall')
         if disable_gc:
             gc.disable()
 
-        start = time.clock()
+        start = timefunc()
         for _ in xrange(ncalls):
             exec code in ns
 
-        elapsed = time.clock() - start
+        elapsed = timefunc() - start
         if disable_gc:
             gc.enable()
 
         return elapsed
 
-    def to_rst(self, image_path=None):
+    def to_rst(self, image_path=None, memory_image_path=None,
+               complexity_image_path=None):
         output = """**Benchmark setup**
 
 .. code-block:: python
@@ -136,33 +424,66 @@ class Benchmark(object):
             output += ("**Performance graph**\n\n.. image:: %s"
                        "\n   :width: 6in" % image_path)
 
+        if memory_image_path is not None:
+            output += ("\n\n**Memory graph**\n\n.. image:: %s"
+                       "\n   :width: 6in" % memory_image_path)
+
+        if complexity_image_path is not None:
+            output += ("\n\n**Complexity graph**\n\n.. image:: %s"
+                       "\n   :width: 6in" % complexity_image_path)
+
         return output
 
-    def plot(self, db_path, label='time', ax=None, title=True):
+    def plot(self, db_path, label='time', ax=None, title=True,
+             column='timing', normalize=False):
+        """
+        column : string
+          column of the results to plot, e.g. 'peak_rss' or 'alloc_peak' of
+          memory benchmarks
+        normalize : boolean
+          plot timings normalized by the reference benchmark (see
+          BenchmarkDB.get_benchmark_results)
+
+        A parameterized benchmark gets a line per parameter value, on a log
+        scale if logy.
+        """
         import matplotlib.pyplot as plt
         from matplotlib.dates import MonthLocator, DateFormatter
 
-        results = self.get_results(db_path)
+        if self.params:
+            timing = self.get_param_results(db_path, column,
+                                            normalize=normalize)
+        elif column == 'timing':
+            timing = self.get_results(db_path, normalize=normalize)[column]
+        else:
+            timing = self.get_results(db_path, extra=[column])[column]
+        timing = timing.astype(float)
+        units = _PLOT_UNITS.get(column, column)
+        if normalize and column == 'timing':
+            units += ' (normalized)'
 
         if ax is None:
             fig = plt.figure()
             ax = fig.add_subplot(111)
 
-        timing = results['timing']
         if self.start_date is not None:
             timing = timing.truncate(before=self.start_date)
 
-        timing.plot(ax=ax, style='b-', label=label)
+        if self.params:
+            timing.plot(ax=ax, logy=self.logy)
+            ax.legend(loc='best', title=', '.join(sorted(self.params)))
+        else:
+            timing.plot(ax=ax, style='b-', label=label)
         ax.set_xlabel('Date')
-        ax.set_ylabel('milliseconds')
+        ax.set_ylabel(units)
 
-        if self.logy:
+        if self.logy and not self.params:
             ax2 = ax.twinx()
             try:
                 timing.plot(ax=ax2, label='%s (log scale)' % label,
                             style='r-',
                             logy=self.logy)
-                ax2.set_ylabel('milliseconds (log scale)')
+                ax2.set_ylabel('%s (log scale)' % units)
                 ax.legend(loc='best')
                 ax2.legend(loc='best')
             except ValueError:
@@ -170,7 +491,7 @@ class Benchmark(object):
 
         ylo, yhi = ax.get_ylim()
 
-        if ylo < 1:
+        if ylo < 1 and not (self.logy and self.params):
             ax.set_ylim([0, yhi])
 
         formatter = DateFormatter("%b %Y")
@@ -183,6 +504,40 @@ class Benchmark(object):
 
         return ax
 
+    def plot_complexity(self, db_path, ax=None, title=True, param=None,
+                        normalize=False):
+        """
+        Plot the complexity exponent over time, see complexity
+        """
+        import matplotlib.pyplot as plt
+
+        exponents = self.complexity(db_path, param=param,
+                                    normalize=normalize)['exponent']
+        exponents = exponents.astype(float)
+        if self.start_date is not None:
+            exponents = exponents.truncate(before=self.start_date)
+
+        if ax is None:
+            fig = plt.figure()
+            ax = fig.add_subplot(111)
+
+        exponents.plot(ax=ax, style='b.-')
+        ax.set_xlabel('Date')
+        ax.set_ylabel('complexity exponent')
+        ylo, yhi = ax.get_ylim()
+        ax.set_ylim([min(ylo, 0), max(yhi, 2.5)])
+
+        if title:
+            ax.set_title('%s: scaling with %s'
+                         % (self.name, param or sorted(self.params)[0]))
+        return ax
+
+
+_PLOT_UNITS = {'timing': 'milliseconds',
+               'peak_rss': 'bytes',
+               'alloc_net': 'bytes',
+               'alloc_peak': 'bytes'}
+
 
 def _get_assigned_name(frame):
     import ast
@@ -278,6 +633,20 @@ def indent(string, spaces=4):
     return '\n'.join([dent + x for x in string.split('\n')])
 
 
+# fixed, pure python workload (not touching the code under test) timed
+# along with the benchmarks to track the speed of the machine, see
+# BenchmarkRunner(reference=True)
+REFERENCE = Benchmark(
+    """sorted(data)
+index = dict((x, i) for i, x in enumerate(data))
+sum(x * x for x in data)
+' '.join(map(repr, data[:2000]))""",
+    """import random
+rng = random.Random(0)
+data = [rng.random() for _ in xrange(20000)]""",
+    ncalls=5, repeat=5, name='vbench_reference')
+
+
 class BenchmarkSuite(list):
     """Basically a list, but the special type is needed for discovery"""
     @property
@@ -285,12 +654,366 @@ class BenchmarkSuite(list):
         """Discard non-benchmark elements of the list"""
         return filter(lambda elem: isinstance(elem, Benchmark), self)
 
+def median_ci(values, z=1.96):
+    """Distribution free confidence interval of the median
+
+    Bounds are the order statistics n/2 -+ z*sqrt(n)/2 (normal
+    approximation to the binomial), so for a handful of values the
+    interval spans all of them.
+    """
+    values = np.sort(values)
+    n = len(values)
+    half = z * np.sqrt(n) / 2.
+    lo = max(int(np.floor(n / 2. - half)), 0)
+    hi = min(int(np.ceil(n / 2. + half)), n - 1)
+    return values[lo], values[hi]
+
+
+def relative_precision(values):
+    """Half-width of the median's 95% confidence interval relative to it"""
+    median = np.median(values)
+    if not median > 0:
+        return np.inf
+    lo, hi = median_ci(values)
+    return (hi - lo) / 2. / median
+
+
+def fit_complexity(sizes, timings, groups=None):
+    """Empirical complexity exponent k of timings ~ sizes ** k
+
+    Least squares slope of log(timings) against log(sizes), allowing a
+    separate intercept for every distinct value in groups.  Failed
+    (None/NaN) or non-positive timings are ignored.  Returns None if there
+    are not at least two distinct sizes within a group to fit to.
+    """
+    if groups is None:
+        groups = [None] * len(sizes)
+    by_group = {}
+    for size, timing, group in zip(sizes, timings, groups):
+        if timing is None or not timing > 0 or not size > 0:
+            continue
+        by_group.setdefault(group, []).append((np.log(size), np.log(timing)))
+
+    sxy = sxx = 0.
+    for pairs in by_group.values():
+        x, y = np.array(pairs).T
+        x = x - x.mean()
+        sxy += np.dot(x, y - y.mean())
+        sxx += np.dot(x, x)
+    if not sxx > 0:
+        return None
+    return sxy / sxx
+
+
+def complexity_changes(exponents, threshold=0.5):
+    """
+    Revisions at which the complexity exponent (as returned by
+    Benchmark.complexity) rose by more than threshold relative to the
+    previous revision with an exponent, e.g. O(n) -> O(n^2)
+
+    Returns a list of (timestamp, revision, previous exponent, exponent)
+    """
+    changes = []
+    previous = None
+    for timestamp, row in exponents.iterrows():
+        exponent = row['exponent']
+        if exponent is None or np.isnan(exponent):
+            continue
+        if previous is not None and exponent - previous > threshold:
+            changes.append((timestamp, row['revision'], previous, exponent))
+        previous = exponent
+    return changes
+
+
+class _StoredStats(object):
+    """Stats dict in the guise of a profiler, to construct pstats.Stats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profile_diff(before, after):
+    """Compare two profiles function by function
+
+    before and after are (ncalls, pstats stats dict) as returned by
+    BenchmarkDB.get_profile.  Returns a DataFrame indexed by function
+    ('file:line(name)'), with cumulative and own times (seconds per call
+    of the benchmark) and number of calls in both profiles, and the
+    differences of the times, sorted by decreasing absolute difference of
+    the cumulative time.  Functions missing from a profile count as 0.
+    """
+    from pandas import DataFrame
+
+    def per_call(profile):
+        ncalls, stats = profile
+        return dict((pstats.func_std_string(func),
+                     (float(ct) / ncalls, float(tt) / ncalls,
+                      float(nc) / ncalls))
+                    for func, (cc, nc, tt, ct, callers) in stats.iteritems())
+
+    before, after = per_call(before), per_call(after)
+    rows = []
+    for func in set(before) | set(after):
+        ct0, tt0, nc0 = before.get(func, (0., 0., 0.))
+        ct1, tt1, nc1 = after.get(func, (0., 0., 0.))
+        rows.append((func, ct0, ct1, ct1 - ct0, tt0, tt1, tt1 - tt0,
+                     nc0, nc1))
+    rows.sort(key=lambda row: -abs(row[3]))
+    return DataFrame.from_records(
+        rows, index='function',
+        columns=['function', 'cumtime_before', 'cumtime_after',
+                 'cumtime_delta', 'tottime_before', 'tottime_after',
+                 'tottime_delta', 'calls_before', 'calls_after'])
+
+
+def _rusage_time(who):
+    def timefunc():
+        usage = resource.getrusage(who)
+        return usage.ru_utime + usage.ru_stime
+    return timefunc
+
+
+# clock of clock_gettime(2) ticking at a constant rate, unaffected by NTP
+# adjustments (Linux)
+CLOCK_MONOTONIC_RAW = 4
+
+
+def _clock_gettime(clock_id):
+    """
+    Function returning seconds of the POSIX clock clock_id, as read by
+    clock_gettime(2) through ctypes, or None if that is not available
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('rt')
+                           or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def timefunc():
+        ts = timespec()
+        if clock_gettime(clock_id, ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    try:
+        timefunc()
+    except OSError:
+        # clock not supported by the kernel
+        return None
+    return timefunc
+
+
+def _available_timers():
+    timers = {'wall': timeit.default_timer}
+
+    if resource is not None:
+        timers['process'] = _rusage_time(resource.RUSAGE_SELF)
+        if sys.platform.startswith('linux'):
+            # RUSAGE_THREAD, which the resource module does not expose
+            timers['thread'] = _rusage_time(1)
+
+    if sys.platform.startswith('linux'):
+        perf_counter = _clock_gettime(CLOCK_MONOTONIC_RAW)
+        if perf_counter is not None:
+            timers['perf_counter'] = perf_counter
+    return timers
+
+# name -> function returning seconds, for the timers available on this
+# platform and python
+TIMERS = _available_timers()
+
+
+def get_timer(name):
+    """Function returning the time in seconds as measured by timer `name`"""
+    try:
+        return TIMERS[name]
+    except KeyError:
+        raise ValueError('Timer %r is not available, choose one of %s'
+                         % (name, ', '.join(sorted(TIMERS))))
+
+
+def _max_rss():
+    """Peak resident set size of this process in bytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on OS X
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def _status_bytes(field):
+    """Value of field (e.g. 'VmHWM') of /proc/self/status in bytes"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                # in kB
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (VmHWM) to the
+    current one.  Returns False where that is not possible, i.e. outside of
+    Linux (>= 4.0)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _status_bytes('VmHWM')
+    except (IOError, OSError, KeyError):
+        return False
+    return True
+
+
+# resource usage accounted while timing, see magic_timeit
+RUSAGE_FIELDS = ('ru_utime', 'ru_stime', 'ru_nvcsw', 'ru_nivcsw',
+                 'ru_majflt', 'ru_minflt')
+
+
+def measure_memory(ns, stmt, collect=False):
+    """Memory used by a single execution of stmt in namespace ns
+
+    Returns the increase of the peak resident set size of the process as
+    'peak_rss' and, if tracemalloc (python 3.4, or the pytracemalloc
+    backport) is available, bytes still allocated after the execution as
+    'alloc_net' and the maximum allocated during it as 'alloc_peak'.
+
+    peak_rss is only meaningful in a fresh process: memory freed by
+    earlier code gets reused without raising RSS, and where the peak can
+    not be reset (outside of Linux) it is 0 unless the execution tops all
+    earlier ones.
+
+    If collect, garbage left behind by earlier code is collected first.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    code = compile(stmt, '<f>', 'exec')
+    if collect:
+        gc.collect()
+    if _reset_peak_rss():
+        max_rss = lambda: _status_bytes('VmHWM')
+    else:
+        max_rss = _max_rss
+    rss_before = max_rss()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        exec code in ns
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    result = {'peak_rss': max_rss() - rss_before}
+    if tracemalloc is not None:
+        result['alloc_net'] = current
+        result['alloc_peak'] = peak
+    return result
+
+
+def _namespace_files(ns):
+    """
+    Source files of the modules bound in namespace ns, or defining its
+    functions and classes
+    """
+    files = set()
+    for value in ns.values():
+        if isinstance(value, types.ModuleType):
+            module = value
+        else:
+            name = getattr(value, '__module__', None)
+            if not isinstance(name, basestring):
+                continue
+            module = sys.modules.get(name)
+        path = _module_file(module)
+        if path is not None:
+            files.add(path)
+    return files
+
+
+def _module_file(module):
+    """
+    Source file of module, None if it has none
+    """
+    path = getattr(module, '__file__', None)
+    if path is not None and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def _imported_modules(module, name, fromlist):
+    """
+    Modules an import statement made available, as __import__(name, ...,
+    fromlist) returned module: the imported ones, submodules named in
+    fromlist, and all their parent packages
+    """
+    base = getattr(module, '__name__', None)
+    if not isinstance(base, basestring):
+        return []
+    if fromlist:
+        names = [base] + ['%s.%s' % (base, item) for item in fromlist]
+    else:
+        # module is the top level package of name (resolved relative to
+        # the importing package, if it was a relative import)
+        names = [base + name[len(name.split('.')[0]):]]
+
+    modules = []
+    for full_name in names:
+        parts = full_name.split('.')
+        for i in range(1, len(parts) + 1):
+            # relative imports leave None entries behind in sys.modules
+            imported = sys.modules.get('.'.join(parts[:i]))
+            if imported is not None:
+                modules.append(imported)
+    return modules
+
+
 # Modified from IPython project, http://ipython.org
 
 
-def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
+def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False,
+                 calibration=None, target_precision=None, time_budget=10.,
+                 timer='wall', collect=False):
     """Time execution of a Python statement or expression
 
+    Time is measured by the given one of TIMERS (see get_timer), which is
+    returned as 'timer'.  time_budget is in wall time regardless.
+
+    If ncalls is None, the number of loops is calibrated, unless
+    calibration (loops, seconds per call) from an earlier run is given and
+    the time per call did not change by more than an order of magnitude
+    since then.  Result of a new calibration is returned as 'calibration'.
+
+    If target_precision is given, the loop is repeated beyond `repeat`
+    times until relative_precision of the timings drops below it, or
+    time_budget seconds pass.  The achieved precision is returned as
+    'precision' in either case.
+
+    Where the resource module is available, the increase of the
+    RUSAGE_FIELDS of resource.getrusage (user and system CPU seconds,
+    voluntary and involuntary context switches, major and minor page
+    faults) over all timed loops, excluding calibration, is returned under
+    the same names.
+
+    timeit disables gc during the loops.  If collect, garbage left behind
+    by earlier code is collected before them, so they start out with a
+    clean slate.
+
     Usage:\\
       %timeit [-n<N> -r<R> [-t|-c]] statement
 
@@ -342,39 +1065,87 @@ def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
     does not matter as long as results from timeit.py are not mixed with
     those from %timeit."""
 
-    import timeit
     import math
 
     units = ["s", "ms", 'us', "ns"]
     scaling = [1, 1e3, 1e6, 1e9]
 
-    timefunc = timeit.default_timer
+    timefunc = get_timer(timer)
+    started = time.time()
 
-    timer = timeit.Timer(timer=timefunc)
+    inner_timer = timeit.Timer(timer=timefunc)
     # this code has tight coupling to the inner workings of timeit.Timer,
     # but is there a better way to achieve that the code stmt has access
     # to the shell namespace?
 
+    # newer timeit templates also take an 'init' part
     src = timeit.template % {'stmt': timeit.reindent(stmt, 8),
-                             'setup': "pass"}
+                             'setup': "pass",
+                             'init': ''}
     # Track compilation time so it can be reported if too long
     # Minimum time above which compilation time will be reported
     code = compile(src, "<magic-timeit>", "exec")
 
     exec code in ns
-    timer.inner = ns["inner"]
+    inner_timer.inner = ns["inner"]
 
-    if ncalls is None:
+    def calibrate():
         # determine number so that 0.2 <= total time < 2.0
         number = 1
         for _ in range(1, 10):
-            if timer.timeit(number) >= 0.1:
+            if inner_timer.timeit(number) >= 0.1:
                 break
             number *= 10
-    else:
+        return number
+
+    usage = dict.fromkeys(RUSAGE_FIELDS, 0)
+
+    def timed(repeat, number):
+        if resource is not None:
+            before = resource.getrusage(resource.RUSAGE_SELF)
+        times = inner_timer.repeat(repeat, number)
+        if resource is not None:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            for field in RUSAGE_FIELDS:
+                usage[field] += getattr(after, field) - getattr(before, field)
+        return [t / number for t in times]
+
+    calibrated = False
+    if ncalls is not None:
         number = ncalls
-
-    best = min(timer.repeat(repeat, number)) / number
+    elif calibration is not None:
+        number = calibration[0]
+        # check a hundredth of the loops first (a single call would mostly
+        # time the timer for fast statements): after a big slowdown, the
+        # repeats with the old number of loops could take orders of
+        # magnitude too long
+        check = max(number // 100, 1)
+        if inner_timer.timeit(check) / check > 10 * calibration[1]:
+            number = calibrate()
+            calibrated = True
+    else:
+        number = calibrate()
+        calibrated = True
+
+    if collect:
+        gc.collect()
+    timings = timed(repeat, number)
+    best = min(timings)
+
+    if (ncalls is None and calibration is not None and not calibrated
+        and not 0.1 <= best / max(calibration[1], 1e-12) <= 10):
+        number = calibrate()
+        calibrated = True
+        usage.update(dict.fromkeys(RUSAGE_FIELDS, 0))
+        timings = timed(repeat, number)
+        best = min(timings)
+
+    if target_precision is not None:
+        while (relative_precision(timings) > target_precision
+               and time.time() - started < time_budget):
+            timings.extend(timed(1, number))
+        best = min(timings)
+    precision = relative_precision(timings)
 
     if force_ms:
         order = 1
@@ -386,10 +1157,18 @@ def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
         else:
             order = 3
 
-    return {'loops': number,
-            'repeat': repeat,
-            'timing': best * scaling[order],
-            'units': units[order]}
+    result = {'loops': number,
+              'repeat': len(timings),
+              'timing': best * scaling[order],
+              'timings': [t * scaling[order] for t in timings],
+              'precision': precision if np.isfinite(precision) else None,
+              'units': units[order],
+              'timer': timer}
+    if resource is not None:
+        result.update(usage)
+    if calibrated:
+        result['calibration'] = (number, best)
+    return result
 
 
 def gather_benchmarks(ns):
@@ -1,9 +1,15 @@
+import marshal
+import zlib
+
+import numpy as np
 from pandas import DataFrame
 
 from sqlalchemy import Table, Column, MetaData, create_engine, ForeignKey
 from sqlalchemy import types as sqltypes
 from sqlalchemy import sql
 
+from vbench.sampling import format_collapsed, parse_collapsed
+
 import logging
 log = logging.getLogger('vb.db')
 
@@ -23,7 +29,11 @@ class BenchmarkDB(object):
         self._benchmarks = Table('benchmarks', self._metadata,
             Column('checksum', sqltypes.String(32), primary_key=True),
             Column('name', sqltypes.String(200), nullable=False),
-            Column('description', sqltypes.Text)
+            Column('description', sqltypes.Text),
+            # for instances of parameterized benchmarks: checksum of the
+            # benchmark they are an instance of, and repr of their params
+            Column('parent', sqltypes.String(32)),
+            Column('params', sqltypes.Text),
         )
         self._results = Table('results', self._metadata,
             Column('checksum', sqltypes.String(32),
@@ -33,6 +43,85 @@ class BenchmarkDB(object):
             Column('ncalls', sqltypes.String(50)),
             Column('timing', sqltypes.Float),
             Column('traceback', sqltypes.Text),
+            # stage at which the benchmark failed (setup, benchmark, crash,
+            # timeout), NULL if it succeeded
+            Column('stage', sqltypes.String(20)),
+            # revision the result was copied from, if the revision did not
+            # touch relevant paths (see BenchmarkRunner)
+            Column('inherited_from', sqltypes.String(50)),
+            # timings of all repeats (little-endian float64s) and their
+            # summary statistics
+            Column('timings', sqltypes.LargeBinary),
+            Column('median', sqltypes.Float),
+            Column('mean', sqltypes.Float),
+            Column('stdev', sqltypes.Float),
+            Column('iqr', sqltypes.Float),
+            # relative half-width of the 95% confidence interval of median
+            Column('precision', sqltypes.Float),
+            # memory used by a single call of memory benchmarks (bytes):
+            # increase of peak RSS, net and peak allocated (tracemalloc)
+            Column('peak_rss', sqltypes.Integer),
+            Column('alloc_net', sqltypes.Integer),
+            Column('alloc_peak', sqltypes.Integer),
+            # resource usage over all timed loops (see magic_timeit): user
+            # and system CPU seconds, voluntary and involuntary context
+            # switches, major and minor page faults
+            Column('ru_utime', sqltypes.Float),
+            Column('ru_stime', sqltypes.Float),
+            Column('ru_nvcsw', sqltypes.Integer),
+            Column('ru_nivcsw', sqltypes.Integer),
+            Column('ru_majflt', sqltypes.Integer),
+            Column('ru_minflt', sqltypes.Integer),
+            # timer the timings were measured with (see benchmark.TIMERS)
+            Column('timer', sqltypes.String(20)),
+            # repr of the dict of conditions the benchmark ran under (see
+            # utils.get_run_settings)
+            Column('settings', sqltypes.Text),
+            # timing (ms) of benchmark.REFERENCE in the same benchmark
+            # process, to normalize for the speed of the machine
+            Column('reference', sqltypes.Float),
+        )
+
+        # source files (relative to the repository) each benchmark executes
+        self._benchmark_files = Table('benchmark_files', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('path', sqltypes.String(1024), primary_key=True),
+        )
+        # benchmarks which were traced, and at which revision, whether or
+        # not any files turned up
+        self._traced = Table('traced', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('revision', sqltypes.String(50)),
+        )
+
+        # number of loops calibrated for benchmarks without fixed ncalls,
+        # and the time per call (in seconds) at the time of calibration
+        self._calibration = Table('calibration', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('loops', sqltypes.Integer, nullable=False),
+            Column('per_call', sqltypes.Float, nullable=False),
+        )
+
+        # cProfile stats (pstats' marshalled dict, zlib compressed) of
+        # ncalls calls of a benchmark at a revision
+        self._profiles = Table('profiles', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('revision', sqltypes.String(50), primary_key=True),
+            Column('ncalls', sqltypes.Integer, nullable=False),
+            Column('stats', sqltypes.LargeBinary, nullable=False),
+        )
+
+        # stacks sampled while running a benchmark at a revision, in the
+        # collapsed format of flame graph tools (zlib compressed)
+        self._stacks = Table('stacks', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('revision', sqltypes.String(50), primary_key=True),
+            Column('stacks', sqltypes.LargeBinary, nullable=False),
         )
 
         self._blacklist = Table('blacklist', self._metadata,
@@ -54,6 +143,28 @@ class BenchmarkDB(object):
         self._benchmarks.create(self._engine, checkfirst=True)
         self._results.create(self._engine, checkfirst=True)
         self._blacklist.create(self._engine, checkfirst=True)
+        self._benchmark_files.create(self._engine, checkfirst=True)
+        self._traced.create(self._engine, checkfirst=True)
+        self._calibration.create(self._engine, checkfirst=True)
+        self._profiles.create(self._engine, checkfirst=True)
+        self._stacks.create(self._engine, checkfirst=True)
+        self._ensure_columns_added(self._benchmarks)
+        self._ensure_columns_added(self._results)
+
+    def _ensure_columns_added(self, table):
+        """
+        Add columns missing from a table created by an older vbench
+        """
+        existing = set(row[1] for row in
+                       self.conn.execute('PRAGMA table_info(%s)' % table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            log.info("Adding column %s to table %s"
+                     % (column.name, table.name))
+            coltype = column.type.compile(dialect=self._engine.dialect)
+            self.conn.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                              % (table.name, column.name, coltype))
 
     def update_name(self, benchmark):
         """
@@ -91,7 +202,10 @@ class BenchmarkDB(object):
         """
         ins = self._benchmarks.insert()
         ins = ins.values(name=bm.name, checksum=bm.checksum,
-                         description=bm.description)
+                         description=bm.description,
+                         parent=bm.parent,
+                         params=(repr(bm.param) if bm.param is not None
+                                 else None))
         self.conn.execute(ins)  # XXX: return the result?
 
     def delete_benchmark(self, checksum):
@@ -101,14 +215,37 @@ class BenchmarkDB(object):
         pass
 
     def write_result(self, checksum, revision, timestamp, ncalls,
-                     timing, traceback=None, overwrite=False):
+                     timing, traceback=None, overwrite=False, stage=None,
+                     inherited_from=None, timings=None, precision=None,
+                     extra=None):
         """
-
+        timings : sequence or None
+          timings of all repeats, stored along with their median, mean,
+          standard deviation and interquartile range
+        precision : float or None
+          relative precision of the median achieved by the repeats
+        extra : dict or None
+          values of further columns of the results table, e.g. peak_rss
         """
+        stats = {}
+        if timings is not None and len(timings):
+            timings = np.asarray(timings, dtype='<f8')
+            q25, q75 = np.percentile(timings, [25, 75])
+            stats = dict(timings=timings.tostring(),
+                         median=float(np.median(timings)),
+                         mean=float(timings.mean()),
+                         stdev=(float(timings.std(ddof=1))
+                                if len(timings) > 1 else None),
+                         iqr=float(q75 - q25))
+
         ins = self._results.insert()
         ins = ins.values(checksum=checksum, revision=revision,
                          timestamp=timestamp,
-                         ncalls=ncalls, timing=timing, traceback=traceback)
+                         ncalls=ncalls, timing=timing, traceback=traceback,
+                         stage=stage, inherited_from=inherited_from,
+                         precision=precision, **stats)
+        if extra:
+            ins = ins.values(**extra)
         self.conn.execute(ins)  # XXX: return the result?
 
     def delete_result(self, checksum, revision):
@@ -155,20 +292,177 @@ class BenchmarkDB(object):
         stmt = self._blacklist.delete()
         self.conn.execute(stmt)
 
-    def get_benchmark_results(self, checksum):
+    def write_benchmark_files(self, checksum, paths, revision=None):
+        """
+        Replace the set of source files traced for a benchmark (at
+        revision), which may well be empty
+        """
+        tab = self._benchmark_files
+        conn = self.conn
+        conn.execute(tab.delete().where(tab.c.checksum == checksum))
+        if paths:
+            conn.execute(tab.insert(),
+                         [dict(checksum=checksum, path=path)
+                          for path in paths])
+        traced = self._traced
+        conn.execute(traced.delete().where(traced.c.checksum == checksum))
+        conn.execute(traced.insert().values(checksum=checksum,
+                                            revision=revision))
+
+    def get_benchmark_files(self):
+        """
+        Returns dict of sets of traced source files by benchmark checksum,
+        for all benchmarks traced so far (with an empty set if none of
+        their files were found)
+        """
+        files = {}
+        stmt = sql.select([self._traced.c.checksum])
+        for checksum, in self.conn.execute(stmt):
+            files[checksum] = set()
+        tab = self._benchmark_files
+        stmt = sql.select([tab.c.checksum, tab.c.path])
+        for checksum, path in self.conn.execute(stmt):
+            files.setdefault(checksum, set()).add(path)
+        return files
+
+    def write_calibration(self, checksum, loops, per_call):
+        tab = self._calibration
+        conn = self.conn
+        conn.execute(tab.delete().where(tab.c.checksum == checksum))
+        conn.execute(tab.insert().values(checksum=checksum, loops=loops,
+                                         per_call=per_call))
+
+    def get_calibrations(self):
+        """
+        Returns dict of (loops, seconds per call) by benchmark checksum
+        """
+        tab = self._calibration
+        stmt = sql.select([tab.c.checksum, tab.c.loops, tab.c.per_call])
+        return dict((checksum, (loops, per_call))
+                    for checksum, loops, per_call in self.conn.execute(stmt))
+
+    def write_profile(self, checksum, revision, ncalls, stats):
         """
+        Replace the profile of a benchmark at a revision
 
+        stats : dict
+          as in pstats.Stats.stats, collected over ncalls calls
+        """
+        tab = self._profiles
+        conn = self.conn
+        conn.execute(tab.delete().where(sql.and_(tab.c.checksum == checksum,
+                                                 tab.c.revision == revision)))
+        conn.execute(tab.insert().values(
+            checksum=checksum, revision=revision, ncalls=ncalls,
+            stats=zlib.compress(marshal.dumps(stats))))
+
+    def get_profile(self, checksum, revision):
+        """
+        Returns (ncalls, stats dict) as passed to write_profile, or None if
+        the benchmark was not profiled at that revision
+        """
+        tab = self._profiles
+        stmt = sql.select([tab.c.ncalls, tab.c.stats],
+                          sql.and_(tab.c.checksum == checksum,
+                                   tab.c.revision == revision))
+        row = self.conn.execute(stmt).fetchone()
+        if row is None:
+            return None
+        return row[0], marshal.loads(zlib.decompress(str(row[1])))
+
+    def write_stacks(self, checksum, revision, stacks):
+        """
+        Replace the stacks (dict of collapsed stack -> samples) sampled for
+        a benchmark at a revision
+        """
+        tab = self._stacks
+        conn = self.conn
+        conn.execute(tab.delete().where(sql.and_(tab.c.checksum == checksum,
+                                                 tab.c.revision == revision)))
+        conn.execute(tab.insert().values(
+            checksum=checksum, revision=revision,
+            stacks=zlib.compress(format_collapsed(stacks))))
+
+    def get_stacks(self, checksum, revision):
+        """
+        Returns the stacks passed to write_stacks, or None if the benchmark
+        was not sampled at that revision
+        """
+        tab = self._stacks
+        stmt = sql.select([tab.c.stacks],
+                          sql.and_(tab.c.checksum == checksum,
+                                   tab.c.revision == revision))
+        row = self.conn.execute(stmt).fetchone()
+        if row is None:
+            return None
+        return parse_collapsed(zlib.decompress(str(row[0])))
+
+    def get_reference_scale(self):
+        """
+        Median timing of the reference benchmark over all results, or None
+        if it was never run
+        """
+        tab = self._results
+        stmt = sql.select([tab.c.reference], tab.c.reference != None)
+        references = [row[0] for row in self.conn.execute(stmt)]
+        if not references:
+            return None
+        return float(np.median(references))
+
+    def get_benchmark_results(self, checksum, stats=False, extra=(),
+                              normalize=False):
+        """
+        stats : boolean
+          also return median, mean, stdev and iqr of the repeats, relative
+          precision of the median, and the timings of all repeats (as
+          arrays)
+        extra : sequence
+          names of further columns to return, e.g. peak_rss
+        normalize : boolean
+          scale timings (and their stats) by the median reference timing
+          (see get_reference_scale) over the reference timing measured
+          along with each result, i.e. to what they would have been on
+          the machine running at its usual speed.  Results without a
+          reference timing get NaN
         """
         tab = self._results
-        stmt = sql.select([tab.c.timestamp, tab.c.revision, tab.c.ncalls,
-                           tab.c.timing, tab.c.traceback],
+        columns = [tab.c.timestamp, tab.c.revision, tab.c.ncalls,
+                   tab.c.timing, tab.c.traceback, tab.c.stage,
+                   tab.c.inherited_from]
+        if stats:
+            columns += [tab.c.median, tab.c.mean, tab.c.stdev, tab.c.iqr,
+                        tab.c.precision, tab.c.timings]
+        columns += [tab.c[name] for name in extra]
+        if normalize and 'reference' not in extra:
+            columns.append(tab.c.reference)
+        stmt = sql.select(columns,
                           sql.and_(tab.c.checksum == checksum))
         results = self.conn.execute(stmt)
 
         df = _sqa_to_frame(results).set_index('timestamp')
+        if stats:
+            df['timings'] = df['timings'].map(decode_timings)
+        if normalize:
+            scale = self.get_reference_scale() or np.nan
+            factor = scale / df['reference'].astype(float)
+            for column in ['timing', 'median', 'mean', 'stdev', 'iqr']:
+                if column in df:
+                    df[column] = df[column].astype(float) * factor
+            if stats:
+                df['timings'] = [None if t is None else t * f
+                                 for t, f in zip(df['timings'], factor)]
         return df.sort_index()
 
 
+def decode_timings(blob):
+    """
+    Timings of all repeats, as stored in the results table, to an array
+    """
+    if blob is None:
+        return None
+    return np.fromstring(str(blob), dtype='<f8')
+
+
 def _sqa_to_frame(result):
     rows = [tuple(x) for x in result]
     if not rows:
@@ -1,17 +1,24 @@
-from dateutil import parser
+from datetime import datetime
+import cPickle as pickle
+import hashlib
 import subprocess
 import os
 import shutil
+import tempfile
 
 import numpy as np
 
 from pandas import Series, DataFrame, Panel
-from vbench.utils import run_cmd
+from vbench.utils import run_cmd, taskset_cmd, matches_any
 
 import logging
 log = logging.getLogger('vb.git')
 
 
+# sources affecting compiled code, which tracing Python calls cannot see
+BUILD_PATHS = ('*.pyx', '*.pxd', '*.pxi', '*.c', '*.cpp', '*.h', 'setup.py')
+
+
 class Repo(object):
 
     def __init__(self):
@@ -23,9 +30,20 @@ class GitRepo(Repo):
     Read some basic statistics about a git repository
     """
 
-    def __init__(self, repo_path):
+    def __init__(self, repo_path, cache_path=None, churn_index_path=None):
+        """
+        cache_path : string or None
+          file to keep parsed commit history in, so that subsequent
+          instantiations only need to parse commits newer than the cached
+          tip of the history
+        churn_index_path : string or None
+          directory to keep a ChurnIndex in, so churn needs to be computed
+          only for commits newer than those already indexed
+        """
         log.info("Initializing GitRepo to look at %s" % repo_path)
         self.repo_path = repo_path
+        self.cache_path = cache_path
+        self.churn_index_path = churn_index_path
         self.git = _git_command(self.repo_path)
         (self.shas, self.messages,
          self.timestamps, self.authors) = self._parse_commit_log()
@@ -37,73 +55,207 @@ class GitRepo(Repo):
 
     def _parse_commit_log(self):
         log.debug("Parsing the commit log of %s" % self.repo_path)
-        githist = self.git + ('log --graph --pretty=format:'
-                              '\"::%h::%cd::%s::%an\" > githist.txt')
-        os.system(githist)
-        githist = open('githist.txt').read()
-        os.remove('githist.txt')
 
         shas = []
         timestamps = []
         messages = []
         authors = []
-        for line in githist.split('\n'):
-            # skip commits not in mainline
-            if not line[0] == '*':
-                continue
-            # split line into three real parts, ignoring git-graph in front
-            _, sha, stamp, message, author = line.split('::', 4)
-
-            # parse timestamp into datetime object
-            stamp = parser.parse(stamp)
+        seen_stamps = set()
+        for sha, stamp, message, author in self._get_commit_records():
             # avoid duplicate timestamps by ignoring them
             # presumably there is a better way to deal with this
-            if stamp in timestamps:
+            if stamp in seen_stamps:
                 continue
+            seen_stamps.add(stamp)
 
             shas.append(sha)
             timestamps.append(stamp)
             messages.append(message)
             authors.append(author)
 
-        # to UTC for now
-        timestamps = _convert_timezones(timestamps)
-
         shas = Series(shas, timestamps)
         messages = Series(messages, shas)
         timestamps = Series(timestamps, shas)
         authors = Series(authors, shas)
         return shas[::-1], messages[::-1], timestamps[::-1], authors[::-1]
 
+    def _get_commit_records(self):
+        """
+        (sha, UTC timestamp, message, author) for mainline commits, latest
+        first, reusing whatever is cached in cache_path
+        """
+        head = self._rev_parse('HEAD')
+
+        cached_tip, cached = None, []
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            try:
+                cached_tip, cached = pickle.load(open(self.cache_path, 'rb'))
+            except Exception, e:
+                log.warn("Ignoring unreadable history cache %s: %s"
+                         % (self.cache_path, e))
+
+        if cached_tip == head:
+            log.debug("History cache is up to date at %s" % head)
+            return cached
+
+        records = None
+        if cached_tip is not None:
+            new, parent = self._read_commit_log('%s..%s' % (cached_tip, head))
+            # cached history must be the continuation of the new commits
+            if new and parent == cached_tip:
+                log.debug("Parsed %d commits past cached %s"
+                          % (len(new), cached_tip))
+                records = new + cached
+
+        if records is None:
+            records, _ = self._read_commit_log(head)
+
+        if self.cache_path is not None:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((head, records), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.cache_path)
+
+        return records
+
+    def _read_commit_log(self, revisions):
+        """
+        Stream `git log --first-parent revisions`
+
+        Returns list of commit records, latest first, and the first parent
+        of the earliest commit
+        """
+        # full sha, abbreviated sha, unix time, parents, author, subject
+        fmt = '%H%x00%h%x00%ct%x00%P%x00%an%x00%s'
+        cmdline = self.git.split() + ['log', '--first-parent',
+                                      '--format=' + fmt, revisions]
+        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
+
+        records = []
+        parent = None
+        for line in iter(proc.stdout.readline, ''):
+            fields = line.rstrip('\n').split('\0', 5)
+            if len(fields) != 6:
+                continue
+            _, sha, stamp, parents, author, message = fields
+            records.append((sha, datetime.utcfromtimestamp(int(stamp)),
+                            message, author))
+            parent = parents.split(' ')[0] or None
+        proc.wait()
+        return records, parent
+
+    def _rev_parse(self, rev):
+        cmdline = self.git.split() + ['rev-parse', rev]
+        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
+        return proc.communicate()[0].strip()
+
     def get_churn(self, omit_shas=None, omit_paths=None):
         churn = self.get_churn_by_file()
 
         if omit_paths is not None:
-            churn = churn.drop(omit_paths, axis='major')
+            churn = churn[~churn['path'].isin(omit_paths)]
 
         if omit_shas is not None:
-            churn = churn.drop(omit_shas, axis='minor')
+            churn = churn[~churn['sha'].isin(omit_shas)]
 
-        # sum files and add insertions + deletions
-        by_commit = churn.sum('major').sum(1)
+        # add insertions + deletions and sum files
+        by_commit = (churn['insertions'] + churn['deletions']).groupby(
+            churn['sha']).sum()
         by_date = by_commit.groupby(self.commit_date).sum()
         return by_date
 
     def get_churn_by_file(self):
-        hashes = self.shas.values
-        prev = hashes[0]
-
-        insertions = {}
-        deletions = {}
+        """
+        Insertions and deletions by file for every mainline commit relative
+        to its first parent
+
+        Returns DataFrame with columns sha, path, insertions, deletions and
+        a row per changed file of each commit (i.e. the sparse, coordinate
+        form of a files x commits table).  Changes of commits dropped from
+        shas due to duplicate timestamps are attributed to the commit kept
+        for that timestamp
+        """
+        index = self._get_churn_index()
+
+        kept_shas = set(self.shas.values)
+        sha_names = np.array([sha if sha in kept_shas
+                              else self.shas.get(stamp, sha)
+                              for sha, stamp in zip(index.shas, index.stamps)],
+                             dtype=object)
+        path_names = np.array(index.paths, dtype=object)
+        commit = index.column('commit')
+        path = index.column('path')
+        return DataFrame(
+            {'sha': sha_names[commit] if len(commit) else [],
+             'path': path_names[path] if len(path) else [],
+             'insertions': np.asarray(index.column('insertions'),
+                                      dtype=np.int64),
+             'deletions': np.asarray(index.column('deletions'),
+                                     dtype=np.int64)},
+            columns=['sha', 'path', 'insertions', 'deletions'])
+
+    def _get_churn_index(self):
+        """
+        ChurnIndex (in memory, unless churn_index_path is set) brought up
+        to date with HEAD
+        """
+        index = ChurnIndex(self.churn_index_path)
+        head = self._rev_parse('HEAD')
+        if index.tip == head:
+            return index
+
+        commits = None
+        if index.tip is not None:
+            commits, parent = self._read_numstat('%s..%s' % (index.tip, head))
+            # indexed history must be the continuation of the new commits
+            if not commits or parent != index.tip:
+                log.info("Rebuilding churn index %s" % index.path)
+                index.clear()
+                commits = None
+
+        if commits is None:
+            commits, _ = self._read_numstat(head)
+        log.debug("Indexing churn of %d commits" % len(commits))
+        index.append(head, commits)
+        return index
+
+    def _read_numstat(self, revisions):
+        """
+        Stream `git log --first-parent --numstat revisions` in a single pass
 
-        for cur in hashes[1:]:
-            i, d = self.diff(cur, prev)
-            insertions[cur] = i
-            deletions[cur] = d
-            prev = cur
-        return Panel({'insertions': DataFrame(insertions),
-                      'deletions': DataFrame(deletions)},
-                     minor_axis=hashes)
+        Returns list of (sha, UTC timestamp, [(path, insertions, deletions),
+        ...]) for commits in chronological order, and the first parent of
+        the earliest commit
+        """
+        fmt = '%x00%h%x00%ct%x00%P'
+        cmdline = self.git.split() + ['log', '--first-parent', '-m',
+                                      '--numstat', '--format=' + fmt,
+                                      revisions]
+        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
+
+        commits = []
+        parent = None
+        rows = None
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            if line.startswith('\0'):
+                _, sha, stamp, parents = line.split('\0')
+                parent = parents.split(' ')[0] or None
+                rows = []
+                commits.append((sha, datetime.utcfromtimestamp(int(stamp)),
+                                rows))
+                continue
+            # root commit has nothing to compare against
+            if parent is None or not line:
+                continue
+            try:
+                i, d, path = line.split('\t')
+                rows.append((path, int(i), int(d)))
+            except ValueError:
+                # binary files have no line counts
+                continue
+        proc.wait()
+        return commits[::-1], parent
 
     def diff(self, sha, prev_sha):
         cmdline = self.git.split() + ['diff', sha, prev_sha, '--numstat']
@@ -130,36 +282,226 @@ class GitRepo(Repo):
         # deletions = int(match.group(2))
         return insertions, deletions
 
+    def changed_paths(self, sha, prev_sha):
+        """
+        Paths changed between prev_sha and sha
+        """
+        cmdline = self.git.split() + ['diff', '--name-only', prev_sha, sha]
+        stdout = subprocess.Popen(cmdline, stdout=subprocess.PIPE).stdout
+        return [path for path in stdout.read().split('\n') if path]
+
     def checkout(self, sha):
         pass
 
+class ChurnIndex(object):
+    """
+    Columnar index of per-file churn: commit index, path id, insertions and
+    deletions, each kept as a flat file of int32s which is memory-mapped on
+    load and only ever appended to.  Commit shas and timestamps, paths and
+    the indexed tip live in a small pickled metadata file.
+
+    If path is None, the index is kept in memory only.
+    """
+
+    _columns = ('commit', 'path', 'insertions', 'deletions')
+    _dtype = np.int32
+
+    def __init__(self, path=None):
+        self.path = path
+        self._arrays = None
+        self._load()
+
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.pickle')
+
+    def _column_path(self, name):
+        return os.path.join(self.path, '%s.i4' % name)
+
+    def _load(self):
+        self.tip, self.shas, self.stamps, self.paths = None, [], [], []
+        self.nrows = 0
+        if self.path is not None and os.path.exists(self._meta_path()):
+            try:
+                (self.tip, self.shas, self.stamps, self.paths,
+                 self.nrows) = pickle.load(open(self._meta_path(), 'rb'))
+            except Exception, e:
+                log.warn("Ignoring unreadable churn index %s: %s"
+                         % (self.path, e))
+                self.clear()
+        self._path_ids = dict((p, i) for i, p in enumerate(self.paths))
+
+    def clear(self):
+        self.tip, self.shas, self.stamps, self.paths = None, [], [], []
+        self.nrows = 0
+        self._path_ids = {}
+        self._arrays = None
+        if self.path is not None and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def column(self, name):
+        if self.path is None:
+            if self._arrays is None:
+                return np.empty(0, dtype=self._dtype)
+            return self._arrays[name]
+        if not self.nrows:
+            return np.empty(0, dtype=self._dtype)
+        return np.memmap(self._column_path(name), dtype=self._dtype,
+                         mode='r', shape=(self.nrows,))
+
+    def append(self, tip, commits):
+        """
+        tip : string
+          sha of the latest commit indexed after this append
+        commits : list
+          (sha, timestamp, [(path, insertions, deletions), ...]) for
+          commits in chronological order
+        """
+        new = dict((name, []) for name in self._columns)
+        for sha, stamp, rows in commits:
+            commit = len(self.shas)
+            self.shas.append(sha)
+            self.stamps.append(stamp)
+            for path, insertions, deletions in rows:
+                path_id = self._path_ids.get(path)
+                if path_id is None:
+                    path_id = self._path_ids[path] = len(self.paths)
+                    self.paths.append(path)
+                new['commit'].append(commit)
+                new['path'].append(path_id)
+                new['insertions'].append(insertions)
+                new['deletions'].append(deletions)
+
+        new = dict((name, np.array(values, dtype=self._dtype))
+                   for name, values in new.iteritems())
+        n_new = len(new['commit'])
+
+        if self.path is None:
+            if self._arrays is None:
+                self._arrays = new
+            else:
+                self._arrays = dict(
+                    (name, np.concatenate([self._arrays[name], new[name]]))
+                    for name in self._columns)
+        else:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            itemsize = np.dtype(self._dtype).itemsize
+            for name in self._columns:
+                column_path = self._column_path(name)
+                with open(column_path, 'r+b' if os.path.exists(column_path)
+                          else 'w+b') as f:
+                    # drop leftovers of an append interrupted before the
+                    # metadata got updated
+                    f.truncate(self.nrows * itemsize)
+                    f.seek(self.nrows * itemsize)
+                    new[name].tofile(f)
+
+        self.nrows += n_new
+        self.tip = tip
+
+        if self.path is not None:
+            tmp_path = self._meta_path() + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((self.tip, self.shas, self.stamps, self.paths,
+                             self.nrows), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._meta_path())
+
+
 class BenchRepo(object):
     """
     Manage an isolated copy of a repository for benchmarking
+
+    Parameters
+    ----------
+    use_worktree : boolean, default: False
+        if True, target_dir is a `git worktree` of the clone in
+        clone_dir instead of a full clone of it.  Hard cleaning then
+        only resets the tree (git clean -fdx + checkout) instead of
+        deleting and re-cloning it
+    clone_dir : string or None
+        where to keep the clean clone of source_url (default:
+        target_dir + '_tmp').  With use_worktree, several BenchRepos
+        may share one clone_dir, and thus one object store
+    build_cache_dir : string or None
+        if given, compiled artifacts are cached there keyed by the hash
+        of the git tree entries matching build_cache_paths (and of
+        build_cmds).  On a hit they are restored into the checkout and
+        the build is skipped
+    build_cache_paths : list of glob patterns
+        paths (relative to the repository root) which affect the build
+    build_cache_artifacts : list of glob patterns
+        files produced by the build which get cached
+    build_cpus : list of int or None
+        CPUs to confine build commands to (via taskset)
     """
+
+    _build_cache_paths = BUILD_PATHS
+    _build_cache_artifacts = ('*.so', '*.pyd')
+
     def __init__(self, source_url, target_dir, build_cmds, prep_cmd,
-                 clean_cmd=None, dependencies=None, always_clean=False):
+                 clean_cmd=None, dependencies=None, always_clean=False,
+                 use_worktree=False, clone_dir=None,
+                 build_cache_dir=None, build_cache_paths=None,
+                 build_cache_artifacts=None, build_cpus=None):
         self.source_url = source_url
         self.target_dir = target_dir
-        self.target_dir_tmp = target_dir + '_tmp'
+        self.target_dir_tmp = clone_dir or target_dir + '_tmp'
         self.build_cmds = build_cmds
         self.prep_cmd = prep_cmd
         self.clean_cmd = clean_cmd
         self.dependencies = dependencies
         self.always_clean = always_clean
+        self.use_worktree = use_worktree
+        self.build_cache_dir = build_cache_dir
+        self.build_cache_paths = build_cache_paths or self._build_cache_paths
+        self.build_cache_artifacts = (build_cache_artifacts
+                                      or self._build_cache_artifacts)
+        self.build_cpus = build_cpus
+        # revision checked out and built, None if unknown or cleaned since
+        self.current_rev = None
         self._clean_checkout()
         self._copy_repo()
 
     def _clean_checkout(self):
+        if self.use_worktree and os.path.exists(self.target_dir_tmp):
+            # clone might be shared with other worktrees -- just refresh it
+            log.debug("Fetching %s into existing %s"
+                      % (self.source_url, self.target_dir_tmp))
+            run_cmd(['git', 'fetch', 'origin'], cwd=self.target_dir_tmp,
+                    stderr_levels=('debug', 'error'))
+            return
         log.debug("Clean checkout of %s from %s"
                   % (self.source_url, self.target_dir_tmp))
         self._clone(self.source_url, self.target_dir_tmp, rm=True)
 
     def _copy_repo(self):
-        log.debug("Repopulating %s" % self.target_dir)
-        self._clone(self.target_dir_tmp, self.target_dir, rm=True)
+        self.current_rev = None
+        if self.use_worktree:
+            self._reset_worktree()
+        else:
+            log.debug("Repopulating %s" % self.target_dir)
+            self._clone(self.target_dir_tmp, self.target_dir, rm=True)
         self._prep()
 
+    def _reset_worktree(self):
+        if os.path.exists(os.path.join(self.target_dir, '.git')):
+            log.debug("Resetting worktree %s" % self.target_dir)
+            run_cmd(['git', 'clean', '-fdx'], cwd=self.target_dir)
+            run_cmd(['git', 'checkout', '-f', 'HEAD'], cwd=self.target_dir,
+                    stderr_levels=('debug', 'error'))
+            return
+
+        if os.path.exists(self.target_dir):
+            log.info('Deleting %s first' % self.target_dir)
+            shutil.rmtree(self.target_dir)
+        log.info("Adding worktree %s of %s"
+                 % (self.target_dir, self.target_dir_tmp))
+        # forget about worktrees which were removed behind git's back
+        run_cmd(['git', 'worktree', 'prune'], cwd=self.target_dir_tmp)
+        run_cmd(['git', 'worktree', 'add', '--detach',
+                 os.path.abspath(self.target_dir)],
+                cwd=self.target_dir_tmp, stderr_levels=('debug', 'error'))
+
     def _clone(self, source, target, rm=False):
         log.info("Cloning %s over to %s" % (source, target))
         if os.path.exists(target):
@@ -198,7 +540,8 @@ class BenchRepo(object):
         self._checkout(rev)
         self._copy_benchmark_scripts_and_deps()
         self._clean_pyc_files()
-        self._build()
+        self._cached_build()
+        self.current_rev = rev
 
     def _checkout(self, rev):
         git = _git_command(self.target_dir)
@@ -208,9 +551,100 @@ class BenchRepo(object):
         proc = run_cmd(args, stderr_levels=('debug', 'error'))
 
     def _build(self):
+        """
+        Returns the exit status of the build commands
+        """
         cmd = ';'.join([x for x in self.build_cmds.split('\n')
                         if len(x.strip()) > 0])
+        cmd = taskset_cmd(cmd, self.build_cpus)
         proc = run_cmd(cmd, shell=True, cwd=self.target_dir)
+        if proc.returncode:
+            log.warn("Build failed with exit code %d in %s"
+                     % (proc.returncode, self.target_dir))
+        return proc.returncode
+
+    def _cached_build(self):
+        if self.build_cache_dir is None:
+            self._build()
+            return
+
+        key = self._get_build_key()
+        cache_path = os.path.join(self.build_cache_dir, key)
+        if os.path.isdir(cache_path):
+            log.info("Restoring cached build %s" % key)
+            _copy_tree(cache_path, self.target_dir)
+            return
+
+        # artifacts left behind by builds of earlier revisions must not be
+        # cached for this one
+        before = self._get_artifacts()
+        if self._build():
+            return
+        self._store_build(cache_path, before)
+
+    def _get_build_key(self):
+        """
+        md5 of the checked out tree entries affecting the build
+        """
+        proc = subprocess.Popen(['git', 'ls-tree', '-r', 'HEAD'],
+                                stdout=subprocess.PIPE,
+                                cwd=self.target_dir, close_fds=True)
+        stdout, _ = proc.communicate()
+
+        md5 = hashlib.md5(self.build_cmds)
+        for line in stdout.split('\n'):
+            if not line:
+                continue
+            # <mode> <type> <sha>\t<path>
+            path = line.split('\t', 1)[1]
+            if matches_any(path, self.build_cache_paths):
+                md5.update(line + '\n')
+        return md5.hexdigest()
+
+    def _get_artifacts(self):
+        """
+        Dict of (mtime, size) of the build artifacts in the checkout by path
+        """
+        artifacts = {}
+        for root, dirs, files in os.walk(self.target_dir):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for f in files:
+                path = os.path.relpath(os.path.join(root, f), self.target_dir)
+                if matches_any(path, self.build_cache_artifacts):
+                    stat = os.stat(os.path.join(self.target_dir, path))
+                    artifacts[path] = (stat.st_mtime, stat.st_size)
+        return artifacts
+
+    def _store_build(self, cache_path, before=None):
+        """
+        Cache the build artifacts which are new or changed compared to the
+        ones (as returned by _get_artifacts) before the build
+        """
+        before = before or {}
+        artifacts = [path for path, stat in self._get_artifacts().iteritems()
+                     if before.get(path) != stat]
+
+        if not artifacts:
+            log.warn("Build produced no artifacts to cache")
+            return
+
+        log.debug("Caching %d build artifacts under %s"
+                  % (len(artifacts), cache_path))
+        if not os.path.exists(self.build_cache_dir):
+            os.makedirs(self.build_cache_dir)
+        # populate aside and rename, so a partial entry is never hit
+        tmp_path = tempfile.mkdtemp(dir=self.build_cache_dir)
+        for path in artifacts:
+            dest = os.path.join(tmp_path, path)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy2(os.path.join(self.target_dir, path), dest)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # another BenchRepo has cached the same build meanwhile
+            shutil.rmtree(tmp_path)
 
     def _prep(self):
         cmd = ';'.join([x for x in self.prep_cmd.split('\n')
@@ -241,15 +675,16 @@ class BenchRepo(object):
                 pass
 
 
-def _convert_timezones(stamps):
-    # tz = config.TIME_ZONE
-    def _convert(dt):
-        offset = dt.tzinfo.utcoffset(dt)
-        dt = dt.replace(tzinfo=None)
-        dt = dt - offset
-        return dt
-
-    return [_convert(x) for x in stamps]
+def _copy_tree(source, target):
+    """
+    Copy files under source into target, overwriting existing ones
+    """
+    for root, dirs, files in os.walk(source):
+        dest_root = os.path.join(target, os.path.relpath(root, source))
+        if not os.path.exists(dest_root):
+            os.makedirs(dest_root)
+        for f in files:
+            shutil.copy2(os.path.join(root, f), os.path.join(dest_root, f))
 
 
 def _git_command(repo_path):
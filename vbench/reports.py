@@ -7,10 +7,22 @@ __license__ = 'MIT'
 
 import os
 
+from vbench.benchmark import complexity_changes
+
 import logging
 log = logging.getLogger('vb.reports')
 
-def generate_rst_files(benchmarks, dbpath, outpath, description=""):
+def generate_rst_files(benchmarks, dbpath, outpath, description="",
+                       complexity_threshold=0.5, normalize=False):
+    """
+    complexity_threshold : float
+      for benchmarks with a single numeric parameter, revisions at which
+      the fitted complexity exponent rose by more than this are listed as
+      complexity regressions
+    normalize : boolean
+      use timings normalized by the reference benchmark (see
+      BenchmarkRunner(reference=True)) for plots and complexity fits
+    """
     import matplotlib as mpl
     mpl.use('Agg')
     import matplotlib.pyplot as plt
@@ -36,7 +48,7 @@ def generate_rst_files(benchmarks, dbpath, outpath, description=""):
         # make the figure
         plt.figure(figsize=(10, 6))
         ax = plt.gca()
-        bmk.plot(dbpath, ax=ax)
+        bmk.plot(dbpath, ax=ax, normalize=normalize)
 
         start, end = ax.get_xlim()
 
@@ -45,7 +57,47 @@ def generate_rst_files(benchmarks, dbpath, outpath, description=""):
         plt.close('all')
 
         fig_rel_path = 'vbench/figures/%s.png' % bmk.name
-        rst_text = bmk.to_rst(image_path=fig_rel_path)
+
+        mem_fig_rel_path = None
+        if bmk.memory:
+            plt.figure(figsize=(10, 6))
+            ax = plt.gca()
+            bmk.plot(dbpath, ax=ax, label='peak RSS increase',
+                     column='peak_rss')
+            start, end = ax.get_xlim()
+            plt.xlim([start - 30, end + 30])
+            plt.savefig(os.path.join(fig_base_path,
+                                     '%s_memory.png' % bmk.name),
+                        bbox_inches='tight')
+            plt.close('all')
+            mem_fig_rel_path = 'vbench/figures/%s_memory.png' % bmk.name
+
+        cplx_fig_rel_path = None
+        changes = []
+        if bmk.params and len(bmk.params) == 1:
+            plt.figure(figsize=(10, 6))
+            ax = plt.gca()
+            bmk.plot_complexity(dbpath, ax=ax, normalize=normalize)
+            plt.savefig(os.path.join(fig_base_path,
+                                     '%s_complexity.png' % bmk.name),
+                        bbox_inches='tight')
+            plt.close('all')
+            cplx_fig_rel_path = 'vbench/figures/%s_complexity.png' % bmk.name
+            changes = complexity_changes(bmk.complexity(dbpath,
+                                                        normalize=normalize),
+                                         threshold=complexity_threshold)
+            for timestamp, rev, before, after in changes:
+                log.warning('Complexity of %s went up from %.2f to %.2f at %s'
+                            % (bmk.name, before, after, rev))
+
+        rst_text = bmk.to_rst(image_path=fig_rel_path,
+                              memory_image_path=mem_fig_rel_path,
+                              complexity_image_path=cplx_fig_rel_path)
+        if changes:
+            rst_text += '\n\n**Complexity regressions**\n\n'
+            rst_text += ''.join('* %s (%s): exponent %.2f -> %.2f\n'
+                                % (rev, timestamp, before, after)
+                                for timestamp, rev, before, after in changes)
         with open(rst_path, 'w') as f:
             f.write(rst_text)
 
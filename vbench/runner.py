@@ -1,22 +1,45 @@
 import cPickle as pickle
+import itertools
 import os
+import signal
 import subprocess
+import threading
+import time
+import Queue
 
-from vbench.git import GitRepo, BenchRepo
-from vbench.db import BenchmarkDB
-from vbench.utils import multires_order
+from vbench.git import GitRepo, BenchRepo, BUILD_PATHS
+from vbench.benchmark import RUSAGE_FIELDS, get_timer
+from vbench.db import BenchmarkDB, decode_timings
+from vbench.utils import (multires_order, discrepancy_next, taskset_cmd,
+                          matches_any, select_by_coverage, THREAD_ENV_VARS)
 
 from datetime import datetime
 
+import numpy as np
+
 import logging
 log = logging.getLogger('vb.runner')
 
+# how often (in seconds) to look for results streamed by vb_run_benchmarks.py
+_POLL_INTERVAL = 1.0
+
 _RUN_ORDERS = dict(
     normal=lambda x:x,
     reverse=lambda x:x[::-1],
     multires=multires_order,
+    # ordered on the fly by BenchmarkRunner._run_adaptive
+    adaptive=lambda x:x,
     )
 
+# number of revisions (in multires order) run by 'adaptive' before it
+# starts chasing discrepancies
+_ADAPTIVE_COARSE = 9
+
+# measurements (and settings) reported by benchmarks which are stored in
+# results columns of the same name
+_MEASUREMENTS = (('peak_rss', 'alloc_net', 'alloc_peak') + RUSAGE_FIELDS
+                 + ('timer', 'settings', 'reference'))
+
 class BenchmarkRunner(object):
     """
 
@@ -36,9 +59,100 @@ class BenchmarkRunner(object):
         reverse: in reverse order (latest first)
         multires: cover all revisions but in the order increasing
                   temporal detail
+        adaptive: after a coarse multires pass, go for the revisions
+                  between measured neighbours whose timings differ the
+                  most relative to noise, so step changes are located
+                  first.  Always runs sequentially
     overwrite : boolean
     dependencies : list or None
         should be list of modules visible in cwd
+    n_workers : int, default: 1
+        number of revisions to benchmark concurrently.  Each worker gets
+        its own BenchRepo checkout (tmp_dir, tmp_dir_w1, tmp_dir_w2, ...)
+    cpu_affinity : list of int or None
+        CPUs to pin benchmark processes to (via taskset).  Worker i is
+        pinned to cpu_affinity[i % len(cpu_affinity)], so with as many
+        CPUs as workers no two workers share a core
+    use_worktree : boolean, default: False
+        make checkouts `git worktree`s sharing a single clone (and object
+        store) in tmp_dir + '_tmp', so hard cleans reset the tree instead
+        of re-cloning it
+    build_cache_dir : string or None
+        directory to cache compiled artifacts in, keyed by the hash of the
+        build-relevant sources, so unchanged revisions skip the build
+    build_cache_paths : list of glob patterns or None
+        sources affecting the build (see BenchRepo)
+    build_cache_artifacts : list of glob patterns or None
+        files produced by the build which get cached (see BenchRepo)
+    prefetch : boolean, default: False
+        pipeline the runs: while benchmarks run for one revision, the
+        next one is checked out and built in a second checkout
+        (tmp_dir_w1).  Not supported together with n_workers > 1
+    build_cpus : list of int or None
+        CPUs to confine builds to.  Should not overlap with cpu_affinity
+        so prefetched builds do not disturb the timings
+    timeout : float or None
+        seconds a single benchmark may run before its process gets killed
+        and the benchmark recorded as failed at stage 'timeout'
+    memory_limit : int or None
+        limit (in bytes) on the address space of the benchmark process,
+        enforced with resource.setrlimit(RLIMIT_AS, ...)
+    isolate : boolean, default: False
+        run each benchmark in a separate process, so that limits apply to
+        it alone and a crash cannot affect other benchmarks.  Benchmarks
+        measuring memory always run in a process of their own
+    include_paths : list of glob patterns or None
+        only run revisions which, compared to the previous candidate
+        revision, change paths matching any of these
+    exclude_paths : list of glob patterns or None
+        changes to paths matching any of these do not count
+    inherit_results : boolean, default: False
+        store results of the previous run revision for the revisions
+        skipped due to include_paths/exclude_paths (as soon as it has been
+        run), marked with inherited_from in the DB
+    git_cache_path : string or None
+        file to cache the parsed commit history of repo_path in (see
+        GitRepo)
+    trace_coverage : boolean, default: False
+        record which source files each benchmark executes, and at a
+        revision run only the benchmarks which executed files changed
+        since the previous candidate revision.  Changes to compiled
+        sources (see git.BUILD_PATHS) still trigger all benchmarks
+    full_sweep_every : int or None
+        with trace_coverage, still run (and re-trace) all benchmarks at
+        every N-th candidate revision
+    timer : string or None
+        timer (see benchmark.TIMERS) for the benchmarks which do not choose
+        one themselves, 'wall' by default
+    profile : boolean, default: False
+        after timing, profile each benchmark with cProfile for as many
+        calls as a timing repeat makes, and store the stats in the DB (see
+        Benchmark.get_profile and Benchmark.profile_diff)
+    sample : float or None
+        after timing, keep running each benchmark for this many seconds
+        sampling its stacks (see sampling.sample), and store them in the DB
+        for flame graphs (see Benchmark.get_stacks and
+        Benchmark.stacks_diff)
+    sample_interval : float
+        seconds of CPU time between samples
+    stabilize : boolean, default: False
+        reduce noise by running benchmark processes with PYTHONHASHSEED
+        fixed to hash_seed, OpenMP/BLAS/numexpr limited to n_threads
+        threads (see utils.THREAD_ENV_VARS), niceness lowered by up to
+        -nice (as far as permitted), and garbage collected before timing
+        and measuring memory.  Combine with cpu_affinity to pin them to
+        CPUs.  Settings in effect are stored with every result anyway
+    nice : int, default: -10
+    hash_seed : int, default: 0
+    n_threads : int, default: 1
+    reference : boolean, default: False
+        time benchmark.REFERENCE at the start of every benchmark process
+        and store its timing with each result, to normalize for drifts in
+        the speed of the machine (see
+        BenchmarkDB.get_benchmark_results(normalize=True))
+    normalize : boolean, default: False
+        look for changes (in bisect and the adaptive run order) in timings
+        normalized by the reference benchmark.  Implies reference
     """
 
     def __init__(self, benchmarks, repo_path, repo_url,
@@ -49,9 +163,38 @@ class BenchmarkRunner(object):
                  start_date=None, overwrite=False,
                  module_dependencies=None,
                  always_clean=False,
-                 use_blacklist=True):
+                 use_blacklist=True,
+                 n_workers=1,
+                 cpu_affinity=None,
+                 use_worktree=False,
+                 build_cache_dir=None,
+                 build_cache_paths=None,
+                 build_cache_artifacts=None,
+                 prefetch=False,
+                 build_cpus=None,
+                 timeout=None,
+                 memory_limit=None,
+                 isolate=False,
+                 include_paths=None,
+                 exclude_paths=None,
+                 inherit_results=False,
+                 git_cache_path=None,
+                 trace_coverage=False,
+                 full_sweep_every=None,
+                 timer=None,
+                 profile=False,
+                 sample=None,
+                 sample_interval=0.001,
+                 stabilize=False,
+                 nice=-10,
+                 hash_seed=0,
+                 n_threads=1,
+                 reference=False,
+                 normalize=False):
         log.info("Initializing benchmark runner for %d benchmarks" % (len(benchmarks)))
         self._benchmarks = None
+        # benchmarks as run: one per instance of parameterized benchmarks
+        self._instances = None
         self._checksums = None
 
         self.start_date = start_date
@@ -61,29 +204,94 @@ class BenchmarkRunner(object):
         self.repo_path = repo_path
         self.db_path = db_path
 
-        self.repo = GitRepo(self.repo_path)
+        self.repo = GitRepo(self.repo_path, cache_path=git_cache_path)
         self.db = BenchmarkDB(db_path)
 
         self.use_blacklist = use_blacklist
 
         self.blacklist = set(self.db.get_rev_blacklist())
 
+        if n_workers < 1:
+            raise ValueError('n_workers must be positive, got %r' % n_workers)
+        if prefetch and n_workers > 1:
+            raise ValueError('prefetch is not supported with n_workers > 1')
+        self.n_workers = n_workers
+        self.cpu_affinity = cpu_affinity
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.isolate = isolate
+        self.include_paths = include_paths
+        self.exclude_paths = exclude_paths
+        self.inherit_results = inherit_results
+        # revisions skipped by path filtering -> where to inherit from
+        self._inherit_from = {}
+        self.trace_coverage = trace_coverage
+        self.full_sweep_every = full_sweep_every
+        # fail now rather than in the benchmark process of every revision;
+        # get_timer raises ValueError for timers not available
+        for name in set([timer] + [bm.timer for bm in benchmarks]):
+            if name is not None:
+                get_timer(name)
+        self.timer = timer
+        self.profile = profile
+        self.sample = sample
+        self.sample_interval = sample_interval
+        self.stabilize = stabilize
+        self.nice = nice
+        self.hash_seed = hash_seed
+        self.n_threads = n_threads
+        self.reference = reference or normalize
+        self.normalize = normalize
+        self._reference_scale = None
+        # previous candidate revision of each, and revisions at which to
+        # run everything despite trace_coverage
+        self._prev_rev = {}
+        self._sweep_revs = set()
+
         # where to copy the repo
         self.tmp_dir = tmp_dir
-        self.bench_repo = BenchRepo(repo_url, self.tmp_dir, build_cmd,
-                                    prep_cmd,
-                                    clean_cmd,
-                                    always_clean=always_clean,
-                                    dependencies=module_dependencies)
+        self.bench_repos = []
+        for i in range(2 if prefetch else n_workers):
+            self.bench_repos.append(
+                BenchRepo(repo_url, self._get_worker_dir(i), build_cmd,
+                          prep_cmd,
+                          clean_cmd,
+                          always_clean=always_clean,
+                          dependencies=module_dependencies,
+                          use_worktree=use_worktree,
+                          clone_dir=(self.tmp_dir + '_tmp'
+                                     if use_worktree else None),
+                          build_cache_dir=build_cache_dir,
+                          build_cache_paths=build_cache_paths,
+                          build_cache_artifacts=build_cache_artifacts,
+                          build_cpus=build_cpus))
+        self.bench_repo = self.bench_repos[0]
+
+        # serializes access to the DB and blacklist across workers
+        self._lock = threading.RLock()
 
         self.benchmarks = benchmarks
 
+    def _get_worker_dir(self, i):
+        if i == 0:
+            return self.tmp_dir
+        return '%s_w%d' % (self.tmp_dir, i)
+
+    def _get_worker_cpus(self, i):
+        if not self.cpu_affinity:
+            return None
+        return [self.cpu_affinity[i % len(self.cpu_affinity)]]
+
     def _get_benchmarks(self):
         return self._benchmarks
 
     def _set_benchmarks(self, benchmarks):
         self._benchmarks = benchmarks
-        self._checksums = [b.checksum for b in benchmarks]
+        # parameterized benchmarks run as one benchmark per parameter value
+        self._instances = [instance for bm in benchmarks
+                           for instance in bm.instances()]
+        self._checksums = [b.checksum for b in self._instances]
         self._register_benchmarks()
 
     benchmarks = property(fget=_get_benchmarks, fset=_set_benchmarks)
@@ -92,69 +300,262 @@ class BenchmarkRunner(object):
     def run(self):
         log.info("Collecting revisions to run")
         revisions = self._get_revisions_to_run()
-        ran_revisions = []
         log.info("Running benchmarks for %d revisions" % (len(revisions),))
-        for rev in revisions:
-            if self.use_blacklist and rev in self.blacklist:
-                log.warn('Skipping blacklisted %s' % rev)
-                continue
+        if self.run_order == 'adaptive':
+            ran_revisions = self._run_adaptive(revisions)
+        elif self.n_workers > 1:
+            ran_revisions = self._run_parallel(revisions)
+        elif self.prefetch:
+            ran_revisions = self._run_pipelined(revisions)
+        else:
+            ran_revisions = []
+            cpus = self._get_worker_cpus(0)
+            for rev in revisions:
+                res = self._run_rev(rev, self.bench_repo, cpus)
+                if res is not None:
+                    ran_revisions.append((rev, res))
+        return ran_revisions
 
-            any_succeeded, n_active = self._run_and_write_results(rev)
-            ran_revisions.append((rev, (any_succeeded, n_active)))
-            log.debug("%s succeeded among %d active benchmarks",
-                      {True: "Some", False: "None"}[any_succeeded],
-                      n_active)
-            if not any_succeeded and n_active > 0:
-                self.bench_repo.hard_clean()
-
-                any_succeeded2, n_active = self._run_and_write_results(rev)
-
-                # just guessing that this revision is broken, should stop
-                # wasting our time
-                if (not any_succeeded2 and n_active > 5
-                    and self.use_blacklist):
-                    log.warn('Blacklisting %s' % rev)
-                    self.db.add_rev_blacklist(rev)
+    def _run_parallel(self, revisions):
+        """
+        Hand out revisions to n_workers threads, each driving its own
+        BenchRepo.  Returned list follows the order of `revisions`.
+        """
+        queue = Queue.Queue()
+        for i, rev in enumerate(revisions):
+            queue.put((i, rev))
+
+        ran = {}
+
+        def worker(bench_repo, cpus):
+            while True:
+                try:
+                    i, rev = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    res = self._run_rev(rev, bench_repo, cpus)
+                except Exception, e:
+                    log.error('Worker in %s failed on revision %s: %s'
+                              % (bench_repo.target_dir, rev, e))
+                    continue
+                if res is not None:
+                    ran[i] = (rev, res)
+
+        threads = []
+        for i, bench_repo in enumerate(self.bench_repos):
+            t = threading.Thread(target=worker,
+                                 args=(bench_repo, self._get_worker_cpus(i)))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return [ran[i] for i in sorted(ran)]
+
+    def _run_pipelined(self, revisions):
+        """
+        Alternate between two checkouts, preparing the next revision in one
+        while benchmarking the current one in the other
+        """
+        ran_revisions = []
+        cpus = self._get_worker_cpus(0)
+        prefetcher = None
+        for i, rev in enumerate(revisions):
+            if prefetcher is not None:
+                prefetcher.join()
+                prefetcher = None
+
+            if i + 1 < len(revisions):
+                prefetcher = threading.Thread(
+                    target=self._prefetch,
+                    args=(revisions[i + 1], self.bench_repos[(i + 1) % 2]))
+                prefetcher.daemon = True
+                prefetcher.start()
+
+            res = self._run_rev(rev, self.bench_repos[i % 2], cpus)
+            if res is not None:
+                ran_revisions.append((rev, res))
+
+        if prefetcher is not None:
+            prefetcher.join()
         return ran_revisions
 
-    def _run_and_write_results(self, rev):
+    def _run_adaptive(self, revisions):
         """
-        Returns True if any runs succeeded
+        Run revisions (in chronological order) as chosen by
+        discrepancy_next
         """
-        n_active_benchmarks, results = self._run_revision(rev)
-        tracebacks = []
+        revisions = list(revisions)
+        checksums = self.checksums
+        timings = np.empty((len(revisions), len(checksums)))
+        timings.fill(np.nan)
+        measured = np.zeros(len(revisions), dtype=bool)
 
-        any_succeeded = False
+        ran_revisions = []
+        cpus = self._get_worker_cpus(0)
+
+        def measure(i):
+            rev = revisions[i]
+            res = self._run_rev(rev, self.bench_repo, cpus)
+            if res is not None:
+                ran_revisions.append((rev, res))
+            results = self.db.get_rev_results(rev)
+            for j, checksum in enumerate(checksums):
+                timing = (self._get_timing(results[checksum])
+                          if checksum in results else None)
+                if timing is not None:
+                    timings[i, j] = timing
+            measured[i] = True
+
+        for i in multires_order(len(revisions))[:_ADAPTIVE_COARSE]:
+            measure(i)
+
+        while True:
+            i = discrepancy_next(timings, measured)
+            if i is None:
+                break
+            measure(i)
+        return ran_revisions
 
-        for checksum, timing in results.iteritems():
-            if 'traceback' in timing:
-                tracebacks.append(timing['traceback'])
+    def _prefetch(self, rev, bench_repo):
+        """
+        Check out and build rev in bench_repo if it is going to be run
+        """
+        if self.use_blacklist and rev in self.blacklist:
+            return
+        with self._lock:
+            if not self._get_benchmarks_for_rev(rev):
+                return
+        log.info('Prefetching revision %s into %s'
+                 % (rev, bench_repo.target_dir))
+        try:
+            bench_repo.switch_to_revision(rev)
+        except Exception, e:
+            # _run_revision will just try again
+            log.warn('Failed to prefetch revision %s: %s' % (rev, e))
+
+    def _run_rev(self, rev, bench_repo, cpus=None):
+        """
+        Run and store results for a single revision, retrying once after
+        a hard clean if nothing succeeded
 
-            timestamp = self.repo.timestamps[rev]
+        Returns None if revision was skipped, (any_succeeded, n_active)
+        otherwise
+        """
+        if self.use_blacklist and rev in self.blacklist:
+            log.warn('Skipping blacklisted %s' % rev)
+            return None
+
+        any_succeeded, n_active = self._run_and_write_results(
+            rev, bench_repo, cpus)
+        log.debug("%s succeeded among %d active benchmarks",
+                  {True: "Some", False: "None"}[any_succeeded],
+                  n_active)
+        if not any_succeeded and n_active > 0:
+            bench_repo.hard_clean()
+
+            any_succeeded2, n_active = self._run_and_write_results(
+                rev, bench_repo, cpus)
+
+            # just guessing that this revision is broken, should stop
+            # wasting our time
+            if (not any_succeeded2 and n_active > 5
+                and self.use_blacklist):
+                log.warn('Blacklisting %s' % rev)
+                with self._lock:
+                    self.db.add_rev_blacklist(rev)
 
-            any_succeeded = any_succeeded or 'timing' in timing
+        if self.inherit_results:
+            self._write_inherited_results(rev)
+        return any_succeeded, n_active
 
+    def _run_and_write_results(self, rev, bench_repo=None, cpus=None):
+        """
+        Returns True if any runs succeeded
+        """
+        # results get written to the DB as they are streamed in
+        n_active_benchmarks, results = self._run_revision(rev, bench_repo,
+                                                          cpus)
+        any_succeeded = any('timing' in timing
+                            for timing in results.itervalues())
+        return any_succeeded, n_active_benchmarks
+
+    def _write_result(self, rev, checksum, timing):
+        timestamp = self.repo.timestamps[rev]
+        with self._lock:
+            if 'settings' in timing:
+                timing = dict(timing, settings=repr(timing['settings']))
             self.db.write_result(checksum, rev, timestamp,
                                  timing.get('loops'),
                                  timing.get('timing'),
-                                 timing.get('traceback'))
-
-        return any_succeeded, n_active_benchmarks
+                                 timing.get('traceback'),
+                                 stage=timing.get('stage'),
+                                 timings=timing.get('timings'),
+                                 precision=timing.get('precision'),
+                                 extra=dict((k, timing[k])
+                                            for k in _MEASUREMENTS
+                                            if k in timing))
+            if 'calibration' in timing:
+                self.db.write_calibration(checksum, *timing['calibration'])
+            if 'profile' in timing:
+                self.db.write_profile(checksum, rev, *timing['profile'])
+            if 'stacks' in timing:
+                self.db.write_stacks(checksum, rev, timing['stacks'])
+            if 'traced_files' in timing:
+                self.db.write_benchmark_files(checksum,
+                                              timing['traced_files'], rev)
+
+    def _write_inherited_results(self, source):
+        """
+        Store the results of source for the revisions skipped in favour of
+        it, where they have none of their own
+        """
+        revs = sorted(rev for rev, inherit_from in self._inherit_from.items()
+                      if inherit_from == source)
+        if not revs:
+            return
+        with self._lock:
+            source_results = self.db.get_rev_results(source)
+            for rev in revs:
+                existing_results = self.db.get_rev_results(rev)
+                timestamp = self.repo.timestamps[rev]
+                for checksum, row in source_results.iteritems():
+                    if checksum in existing_results:
+                        continue
+                    log.debug('Inheriting result of %s at %s from %s'
+                              % (checksum, rev, source))
+                    self.db.write_result(checksum, rev, timestamp,
+                                         row.ncalls, row.timing,
+                                         row.traceback, stage=row.stage,
+                                         inherited_from=(row.inherited_from
+                                                         or source),
+                                         timings=decode_timings(row.timings),
+                                         precision=row.precision,
+                                         extra=dict((k, row[k])
+                                                    for k in _MEASUREMENTS))
 
     def _register_benchmarks(self):
         log.info('Getting benchmarks')
         ex_benchmarks = self.db.get_benchmarks()
         db_checksums = set(ex_benchmarks.index)
         log.info("Registering %d benchmarks" % len(ex_benchmarks))
-        for bm in self.benchmarks:
+        for bm in self._instances:
             if bm.checksum in db_checksums:
                 self.db.update_name(bm)
             else:
                 log.info('Writing new benchmark %s, %s' % (bm.name, bm.checksum))
                 self.db.write_benchmark(bm)
 
-    def _run_revision(self, rev):
-        need_to_run = self._get_benchmarks_for_rev(rev)
+    def _run_revision(self, rev, bench_repo=None, cpus=None,
+                      benchmarks=None):
+        if bench_repo is None:
+            bench_repo = self.bench_repo
+
+        with self._lock:
+            need_to_run = self._get_benchmarks_for_rev(rev, benchmarks)
 
         if not need_to_run:
             log.info('No benchmarks need running at %s' % rev)
@@ -164,22 +565,138 @@ class BenchmarkRunner(object):
         for bm in need_to_run:
             log.debug(bm.name)
 
-        self.bench_repo.switch_to_revision(rev)
+        if bench_repo.current_rev != rev:
+            bench_repo.switch_to_revision(rev)
+
+        trace = False
+        if self.trace_coverage:
+            with self._lock:
+                coverage = self.db.get_benchmark_files()
+            trace = (rev in self._sweep_revs or
+                     any(bm.checksum not in coverage for bm in need_to_run))
+
+        results = {}
+        remaining = need_to_run
+        while remaining:
+            if self.isolate or remaining[0].memory:
+                batch = remaining[:1]
+            else:
+                # memory benchmarks get a process of their own
+                batch = list(itertools.takewhile(lambda bm: not bm.memory,
+                                                 remaining))
+            n_results = len(results)
+            started, failure = self._run_benchmarks(
+                rev, bench_repo, batch, cpus, results, trace)
+
+            if bench_repo.current_rev != rev:
+                # got hard cleaned, nothing else can run in this checkout
+                break
+
+            if [bm for bm in batch if bm.checksum not in results]:
+                if started is not None and started not in results:
+                    # record the benchmark which took the process down
+                    # and carry on with the ones after it
+                    log.warn('Benchmark %s failed at stage %s at revision '
+                             '%s' % (started, failure['stage'], rev))
+                    results[started] = failure
+                    self._write_result(rev, started, failure)
+                elif len(results) == n_results:
+                    # died before getting to any benchmark
+                    log.warn('Failed for revision %s' % rev)
+                    break
+                # otherwise died in between benchmarks: the ones which
+                # did not get to start run again in a new process
+
+            remaining = [bm for bm in remaining
+                         if bm.checksum not in results]
+
+        return len(need_to_run), results
+
+    def _run_benchmarks(self, rev, bench_repo, benchmarks, cpus, results,
+                        trace=False):
+        """
+        Run benchmarks in a vb_run_benchmarks.py process, writing results
+        to the DB and into the results dict as they are reported
 
-        pickle_path = os.path.join(self.tmp_dir, 'benchmarks.pickle')
-        results_path = os.path.join(self.tmp_dir, 'results.pickle')
+        Returns checksum of the last benchmark which was started (or
+        None) and the failure result to record for it in case it did not
+        report back
+        """
+        work_dir = bench_repo.target_dir
+        pickle_path = os.path.join(work_dir, 'benchmarks.pickle')
+        results_path = os.path.join(work_dir, 'results.pickle')
         if os.path.exists(results_path):
             os.remove(results_path)
-        pickle.dump(need_to_run, open(pickle_path, 'w'))
+        with self._lock:
+            calibrations = self.db.get_calibrations()
+        calibrations = dict((bm.checksum, calibrations[bm.checksum])
+                            for bm in benchmarks
+                            if bm.checksum in calibrations)
+        options = dict(timer=self.timer, profile=self.profile,
+                       sample=self.sample,
+                       sample_interval=self.sample_interval,
+                       reference=self.reference, collect=self.stabilize)
+        pickle.dump((benchmarks, calibrations, options),
+                    open(pickle_path, 'w'))
 
         # run the process
-        cmd = 'python vb_run_benchmarks.py %s %s' % (pickle_path, results_path)
+        cmd = 'python vb_run_benchmarks.py %s%s %s' % (
+            '--trace ' if trace else '', pickle_path, results_path)
+        cmd = taskset_cmd(cmd, cpus)
         log.debug("CMD: %s" % cmd)
+        # running python code between fork and exec is not safe with other
+        # threads around (n_workers, prefetch): only do so when needed
+        preexec_fn = None
+        if (self.stabilize or self.timeout is not None
+            or self.memory_limit is not None):
+            preexec_fn = self._preexec_benchmarks
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 shell=True,
-                                cwd=self.tmp_dir)
-        stdout, stderr = proc.communicate()
+                                cwd=work_dir,
+                                env=self._get_benchmarks_env(),
+                                preexec_fn=preexec_fn,
+                                # not the pipes of other workers' processes
+                                close_fds=True)
+
+        # drain the pipes aside while consuming the streamed results
+        output = {}
+
+        def communicate():
+            output['stdout'], output['stderr'] = proc.communicate()
+
+        communicator = threading.Thread(target=communicate)
+        communicator.daemon = True
+        communicator.start()
+
+        # 'since' is when the process last showed any progress
+        state = {'offset': 0, 'started': None, 'since': time.time(),
+                 'timed_out': False}
+
+        def consume():
+            records, state['offset'] = _read_records(results_path,
+                                                     state['offset'])
+            for checksum, timing in records:
+                state['since'] = time.time()
+                if timing is None:
+                    state['started'] = checksum
+                    continue
+                results[checksum] = timing
+                self._write_result(rev, checksum, timing)
+
+        while communicator.is_alive():
+            communicator.join(_POLL_INTERVAL)
+            consume()
+            if (self.timeout is not None and communicator.is_alive()
+                and time.time() - state['since'] > self.timeout):
+                log.warn('Killing benchmark process for revision %s: no '
+                         'progress in %s seconds' % (rev, self.timeout))
+                state['timed_out'] = True
+                _kill_process_group(proc)
+                communicator.join()
+        consume()
+
+        stdout, stderr = output.get('stdout'), output.get('stderr')
 
         if stdout:
             log.debug('stdout: %s' % stdout)
@@ -192,36 +709,239 @@ class BenchmarkRunner(object):
             if ("object has no attribute" in stderr or
                 'ImportError' in stderr):
                 log.warn('HARD CLEANING!')
-                self.bench_repo.hard_clean()
-
-        if not os.path.exists(results_path):
-            log.warn('Failed for revision %s' % rev)
-            return len(need_to_run), {}
-
-        results = pickle.load(open(results_path, 'r'))
+                bench_repo.hard_clean()
 
         try:
             os.remove(pickle_path)
         except OSError:
             pass
 
-        return len(need_to_run), results
+        if state['timed_out']:
+            failure = {'succeeded': False,
+                       'stage': 'timeout',
+                       'traceback': ('Benchmark did not finish within %s '
+                                     'seconds' % self.timeout)}
+        else:
+            failure = {'succeeded': False,
+                       'stage': 'crash',
+                       'traceback': ('Benchmark process exited with code '
+                                     '%s\n%s' % (proc.returncode, stderr))}
+        return state['started'], failure
 
-    def _get_benchmarks_for_rev(self, rev):
+    def _get_benchmarks_env(self):
+        """
+        Environment of the benchmark process
+        """
+        env = os.environ.copy()
+        if self.stabilize:
+            env['PYTHONHASHSEED'] = str(self.hash_seed)
+            for var in THREAD_ENV_VARS:
+                env[var] = str(self.n_threads)
+        return env
+
+    def _preexec_benchmarks(self):
+        """
+        Executed in the forked benchmark process, just before exec
+        """
+        if self.stabilize:
+            # raise priority as far as we are allowed to
+            for increment in range(min(self.nice, 0), 0):
+                try:
+                    os.nice(increment)
+                    break
+                except OSError:
+                    pass
+        if self.timeout is not None:
+            # own process group, so that all of it could get killed
+            os.setsid()
+        if self.memory_limit is not None:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (self.memory_limit, self.memory_limit))
+
+    def _get_benchmarks_for_rev(self, rev, benchmarks=None):
+        if benchmarks is None:
+            benchmarks = self._instances
+        else:
+            benchmarks = [instance for bm in benchmarks
+                          for instance in bm.instances()]
         existing_results = self.db.get_rev_results(rev)
         need_to_run = []
 
         timestamp = self.repo.timestamps[rev]
 
-        for b in self.benchmarks:
+        for b in benchmarks:
             if b.start_date is not None and b.start_date > timestamp:
                 continue
 
             if b.checksum not in existing_results:
                 need_to_run.append(b)
 
+        if self.trace_coverage and benchmarks is self._instances:
+            need_to_run = self._select_by_coverage(rev, need_to_run)
+
         return need_to_run
 
+    def _select_by_coverage(self, rev, benchmarks):
+        """
+        Keep benchmarks which were not traced yet or executed files changed
+        since the previous candidate revision.  Benchmarks executing none
+        of the repository's files only run on changes to BUILD_PATHS and
+        full sweeps
+        """
+        prev = self._prev_rev.get(rev)
+        if prev is None or rev in self._sweep_revs or not benchmarks:
+            return benchmarks
+
+        changed = self.repo.changed_paths(rev, prev)
+        if [path for path in changed if matches_any(path, BUILD_PATHS)]:
+            return benchmarks
+
+        selected = select_by_coverage(benchmarks,
+                                      self.db.get_benchmark_files(), changed)
+        log.info('%d out of %d benchmarks executed files changed in %s'
+                 % (len(selected), len(benchmarks), rev))
+        return selected
+
+    def _filter_revisions(self, revs):
+        """
+        Drop revisions which change no relevant paths since the previous
+        candidate, remembering the run revision each one could inherit
+        results from
+        """
+        self._inherit_from = {}
+        relevant = []
+        prev = None
+        for rev in revs:
+            if prev is None or self._changes_relevant_paths(rev, prev):
+                relevant.append(rev)
+            else:
+                self._inherit_from[rev] = relevant[-1]
+            prev = rev
+        log.info('%d out of %d revisions change relevant paths'
+                 % (len(relevant), len(revs)))
+        return np.array(relevant)
+
+    def _changes_relevant_paths(self, rev, prev):
+        for path in self.repo.changed_paths(rev, prev):
+            if (self.include_paths is not None
+                and not matches_any(path, self.include_paths)):
+                continue
+            if (self.exclude_paths is not None
+                and matches_any(path, self.exclude_paths)):
+                continue
+            return True
+        return False
+
+    def bisect(self, good, bad, benchmarks=None, threshold=0.1):
+        """
+        Find the first revision between good and bad at which benchmark
+        timings changed, measuring only O(log n) revisions in between
+
+        Only benchmarks whose timings at good and bad differ by more than
+        threshold (relative to good) are looked at.  A revision is
+        considered "bad" if the timings of most of them are closer to those
+        at bad than to those at good.  Revisions which fail to run are
+        skipped.
+
+        Parameters
+        ----------
+        good : string
+            revision (as in repo.shas) before the change
+        bad : string
+            revision after the change
+        benchmarks : list of Benchmark objects or None
+            benchmarks to look at, all of them by default (parameterized
+            ones stand for all of their instances)
+        threshold : float
+            relative change between good and bad below which a benchmark
+            is considered unchanged (i.e. noise)
+
+        Returns
+        -------
+        (last_good, first_bad) : tuple of revisions
+        """
+        if benchmarks is None:
+            benchmarks = self._instances
+        else:
+            benchmarks = [instance for bm in benchmarks
+                          for instance in bm.instances()]
+
+        revs = list(self.repo.shas.sort_index().values)
+        for rev in (good, bad):
+            if rev not in revs:
+                raise ValueError('unknown revision %r' % rev)
+        lo, hi = revs.index(good), revs.index(bad)
+        if lo >= hi:
+            raise ValueError('good revision %s must precede bad revision %s'
+                             % (good, bad))
+
+        good_timings = self._get_rev_timings(good, benchmarks)
+        bad_timings = self._get_rev_timings(bad, benchmarks)
+        checksums = [bm.checksum for bm in benchmarks
+                     if good_timings.get(bm.checksum) is not None
+                     and bad_timings.get(bm.checksum) is not None
+                     and abs(bad_timings[bm.checksum]
+                             - good_timings[bm.checksum])
+                         > threshold * good_timings[bm.checksum]]
+        if not checksums:
+            raise ValueError('no benchmark timings differ by more than %g '
+                             'between %s and %s' % (threshold, good, bad))
+
+        log.info('Bisecting %d revisions between %s and %s over %d '
+                 'benchmarks' % (hi - lo - 1, good, bad, len(checksums)))
+        skipped = set()
+        while True:
+            candidates = [i for i in range(lo + 1, hi) if i not in skipped]
+            if not candidates:
+                break
+            mid = candidates[len(candidates) // 2]
+
+            timings = self._get_rev_timings(revs[mid], benchmarks)
+            # where timings lie relative to good (0) and bad (1) ones, so
+            # that no single benchmark can outweigh the others
+            positions = [min(max((timings[c] - good_timings[c])
+                                 / (bad_timings[c] - good_timings[c]), 0), 1)
+                         for c in checksums if timings.get(c) is not None]
+            if not positions:
+                log.warn('Skipping revision %s which failed to run'
+                         % revs[mid])
+                skipped.add(mid)
+                continue
+
+            if np.median(positions) > 0.5:
+                hi = mid
+            else:
+                lo = mid
+            log.info('Narrowed down to %s..%s' % (revs[lo], revs[hi]))
+
+        return revs[lo], revs[hi]
+
+    def _get_rev_timings(self, rev, benchmarks):
+        """
+        Returns dict of timings (None if failed) at rev by checksum,
+        running those benchmarks which were not run yet
+        """
+        if not (self.use_blacklist and rev in self.blacklist):
+            self._run_revision(rev, benchmarks=benchmarks)
+        results = self.db.get_rev_results(rev)
+        return dict((bm.checksum, self._get_timing(results[bm.checksum]))
+                    for bm in benchmarks if bm.checksum in results)
+
+    def _get_timing(self, row):
+        """
+        Timing of a results row, normalized by the reference benchmark if
+        normalize (None if it is missing)
+        """
+        if not self.normalize or row.timing is None:
+            return row.timing
+        if not row.reference:
+            return None
+        if self._reference_scale is None:
+            # fixed for the run, so that normalized timings stay comparable
+            self._reference_scale = self.db.get_reference_scale()
+        return row.timing * self._reference_scale / row.reference
+
     def _get_revisions_to_run(self):
 
         # TODO generalize someday to other vcs...git only for now
@@ -248,9 +968,47 @@ class BenchmarkRunner(object):
         else:
             raise ValueError('unrecognized run_option=%r' % self.run_option)
 
+        if self.include_paths is not None or self.exclude_paths is not None:
+            revs_to_run = self._filter_revisions(revs_to_run)
+
+        chronological = list(revs_to_run)
+        self._prev_rev = dict(zip(chronological[1:], chronological[:-1]))
+        if self.full_sweep_every:
+            self._sweep_revs = set(chronological[::self.full_sweep_every])
+
         if not self.run_order in _RUN_ORDERS:
             raise ValueError('unrecognized run_order=%r. Must be among %s'
                              % (self.run_order, _RUN_ORDERS.keys()))
         revs_to_run = _RUN_ORDERS[self.run_order](revs_to_run)
 
         return revs_to_run
+
+
+def _read_records(path, offset=0):
+    """
+    Read complete pickled records appended to path past offset
+
+    Returns list of records and the offset past the last complete one
+    """
+    records = []
+    if not os.path.exists(path):
+        return records, offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            try:
+                record = pickle.load(f)
+            except Exception:
+                # end of file, or a record which is not fully written yet
+                break
+            records.append(record)
+            offset = f.tell()
+    return records, offset
+
+
+def _kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # already gone
+        pass
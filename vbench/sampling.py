@@ -0,0 +1,104 @@
+"""Statistical profiling of benchmarks into collapsed stacks
+
+Stacks are sampled on SIGPROF (see signal.setitimer), so the overhead is
+that of the signal handler at every interval of CPU time, instead of
+cProfile's on every call.  Results are kept as dicts of collapsed stacks
+('outer;inner;innermost' -> number of samples), which format_collapsed
+writes in the format read by flame graph tools such as Brendan Gregg's
+flamegraph.pl, and diff_collapsed in the two column format of its
+difffolded.pl for differential flame graphs.
+"""
+
+import os
+import signal
+import sys
+import time
+
+
+def sample(ns, stmt, duration=1., interval=0.001, root=None):
+    """Sample stacks of executing stmt in namespace ns repeatedly
+
+    duration : float
+      seconds to keep executing stmt for (it is executed at least once)
+    interval : float
+      seconds of CPU time between samples
+    root : string or None
+      directory paths under which are shown relative to it
+
+    Returns dict of collapsed stack -> number of samples, frames (with the
+    outermost, stmt's own '<module> (<f>:1)', first) being named
+    'function (file:first line)'.  Time in builtins is charged to the
+    calling frame.  Not available on Windows, and only from the main
+    thread.
+    """
+    code = compile(stmt, '<f>', 'exec')
+    stacks = {}
+    # frames from here outwards are not of interest
+    top = sys._getframe()
+
+    def name(frame):
+        path = frame.f_code.co_filename
+        if root is not None and os.path.isabs(path):
+            rel = os.path.relpath(path, root)
+            if not rel.startswith(os.pardir):
+                path = rel
+        return '%s (%s:%d)' % (frame.f_code.co_name, path,
+                               frame.f_code.co_firstlineno)
+
+    def handler(signum, frame):
+        names = []
+        while frame is not None and frame is not top:
+            names.append(name(frame))
+            frame = frame.f_back
+        if frame is None or not names:
+            # sampled outside of stmt, e.g. in the loop below
+            return
+        stack = ';'.join(reversed(names))
+        stacks[stack] = stacks.get(stack, 0) + 1
+
+    previous = signal.signal(signal.SIGPROF, handler)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        end = time.time() + duration
+        while True:
+            exec code in ns
+            if time.time() >= end:
+                break
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+    return stacks
+
+
+def format_collapsed(stacks):
+    """Lines 'stack count', as read by flamegraph.pl"""
+    return ''.join('%s %d\n' % (stack, count)
+                   for stack, count in sorted(stacks.iteritems()))
+
+
+def parse_collapsed(text):
+    """Inverse of format_collapsed"""
+    stacks = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        stack, count = line.rsplit(' ', 1)
+        stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+def diff_collapsed(before, after, normalize=True):
+    """Lines 'stack count_before count_after' of two collapsed stack dicts
+
+    The format of difffolded.pl, which flamegraph.pl renders as a
+    differential flame graph of after, colored by the change from before.
+    With normalize, counts of before are scaled to the total of after, so
+    that only shifts in the distribution show up.
+    """
+    scale = 1.
+    if normalize and before and after:
+        scale = float(sum(after.itervalues())) / sum(before.itervalues())
+    return ''.join('%s %d %d\n' % (stack,
+                                   int(round(before.get(stack, 0) * scale)),
+                                   after.get(stack, 0))
+                   for stack in sorted(set(before) | set(after)))
@@ -1,30 +1,194 @@
+import os
 import sys
+import traceback
 import cPickle as pickle
 
-if len(sys.argv) != 3:
-    print('Usage: script.py input output')
+from vbench.benchmark import REFERENCE
+from vbench.utils import get_run_settings
+
+args = sys.argv[1:]
+# trace which of the files under the current directory every benchmark
+# executes (before it is timed)
+trace = '--trace' in args
+if trace:
+    args.remove('--trace')
+
+if len(args) != 2:
+    print('Usage: script.py [--trace] input output')
     sys.exit()
 
-in_path, out_path = sys.argv[1:]
-benchmarks = pickle.load(open(in_path))
+in_path, out_path = args
+# benchmarks, loop calibrations (loops, seconds per call) by checksum, and
+# options of the runner
+benchmarks, calibrations, options = pickle.load(open(in_path))
+
+# Results are streamed as (checksum, result) records appended to out_path,
+# preceded by a (checksum, None) record announcing the start of each
+# benchmark.  That way everything reported before a crash survives and the
+# runner knows which benchmark took the process down.
+out = open(out_path, 'ab')
+
+# recorded with every result
+settings = dict(get_run_settings(), gc_collect=options.get('collect', False))
+
+# timing of the reference benchmark, also recorded with every result, to
+# tell how fast the machine was running.  Timed after the first benchmark
+# (see get_reference), so that a memory benchmark does not get to reuse the
+# heap it freed
+reference = {}
+
+
+def get_reference():
+    if 'timing' not in reference:
+        reference['timing'] = None
+        res = REFERENCE.run(timer=options.get('timer'),
+                            collect=options.get('collect', False))
+        if res['succeeded']:
+            reference['timing'] = res['timing']
+        else:
+            print("E: Reference benchmark failed\n%s" % res['traceback'])
+    return reference['timing']
+
+
+def report(checksum, res):
+    pickle.dump((checksum, res), out, pickle.HIGHEST_PROTOCOL)
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def trace_files(bmk):
+    cwd = os.getcwd()
+    files = set()
+    for path in bmk.trace():
+        # skip pseudo files such as <string>
+        if not os.path.isfile(path):
+            continue
+        path = os.path.relpath(os.path.abspath(path), cwd)
+        if not path.startswith(os.pardir):
+            files.add(path)
+    return sorted(files)
+
+
+def profile(bmk, ncalls):
+    """
+    (ncalls, pstats stats dict) of profiling ncalls calls, with files under
+    the current directory made relative to it, so profiles taken in
+    different checkouts compare equal
+    """
+    cwd = os.getcwd()
+
+    def relative(func):
+        path = func[0]
+        if os.path.isabs(path):
+            rel = os.path.relpath(path, cwd)
+            if not rel.startswith(os.pardir):
+                return (rel,) + func[1:]
+        return func
+
+    stats = {}
+    for func, (cc, nc, tt, ct, callers) in bmk.profile(ncalls).stats.items():
+        callers = dict((relative(caller), value)
+                       for caller, value in callers.items())
+        stats[relative(func)] = (cc, nc, tt, ct, callers)
+    return ncalls, stats
+
+
+def group_by_setup(benchmarks):
+    """
+    Group benchmarks which share their setup (see Benchmark.share_setup),
+    keeping the order of first appearance
+    """
+    groups = []
+    by_key = {}
+    for bmk in benchmarks:
+        if not bmk.share_setup:
+            groups.append([bmk])
+        elif bmk.setup_checksum in by_key:
+            by_key[bmk.setup_checksum].append(bmk)
+        else:
+            by_key[bmk.setup_checksum] = [bmk]
+            groups.append(by_key[bmk.setup_checksum])
+    return groups
+
+
+def run(bmk, ns):
+    # traced first, so that modules first imported by the benchmark get
+    # their module level code traced too
+    traced_files = None
+    if trace:
+        try:
+            traced_files = trace_files(bmk)
+        except Exception, e:
+            print("E: Got an exception while tracing %s\n%s" % (bmk, e))
 
-results = {}
-errors = 0
-for bmk in benchmarks:
     try:
-        res = bmk.run()
+        res = bmk.run(calibration=calibrations.get(bmk.checksum),
+                      timer=options.get('timer'), ns=ns,
+                      collect=options.get('collect', False))
     except Exception, e:
-        errors += 1
         print("E: Got an exception while running %s\n%s" % (bmk, e))
-        continue
+        return {'succeeded': False,
+                'stage': 'UNKNOWN',
+                'traceback': traceback.format_exc()}
+
+    if traced_files is not None and res['succeeded']:
+        res['traced_files'] = traced_files
+
+    if options.get('profile') and res['succeeded']:
+        try:
+            res['profile'] = profile(bmk, res['loops'])
+        except Exception, e:
+            print("E: Got an exception while profiling %s\n%s" % (bmk, e))
+
+    if options.get('sample') and res['succeeded']:
+        try:
+            res['stacks'] = bmk.sample(options['sample'],
+                                       options['sample_interval'],
+                                       root=os.getcwd())
+        except Exception, e:
+            print("E: Got an exception while sampling %s\n%s" % (bmk, e))
+
+    if res['succeeded']:
+        res['settings'] = settings
+        if options.get('reference') and get_reference() is not None:
+            res['reference'] = get_reference()
+    return res
+
+errors = 0
+for group in group_by_setup(benchmarks):
+    # namespace set up once for the whole group, None to leave it to run()
+    ns = None
+    setup_error = None
+    for bmk in group:
+        # announced before the shared setup, so a crash in it is charged
+        # to the first benchmark of the group
+        report(bmk.checksum, None)
+        if len(group) > 1 and bmk is group[0]:
+            try:
+                ns = bmk._setup()
+            except Exception:
+                setup_error = traceback.format_exc()
+
+        if setup_error is not None:
+            res = {'succeeded': False,
+                   'stage': 'setup',
+                   'traceback': setup_error}
+        else:
+            res = run(bmk, ns)
+        report(bmk.checksum, res)
 
-    results[bmk.checksum] = res
+        if not res['succeeded']:
+            errors += 1
+            print("I: Failed to succeed with %s in stage %s."
+                   % (bmk, res.get('stage', 'UNKNOWN')))
+            print(res.get('traceback', 'Traceback: UNKNOWN'))
 
-    if not res['succeeded']:
-        errors += 1
-        print("I: Failed to succeed with %s in stage %s."
-               % (bmk, res.get('stage', 'UNKNOWN')))
-        print(res.get('traceback', 'Traceback: UNKNOWN'))
+    if ns is not None:
+        try:
+            group[0]._cleanup(ns)
+        except Exception, e:
+            print("E: Got an exception while cleaning up after %s\n%s"
+                  % (group[0], e))
 
-benchmarks = pickle.dump(results, open(out_path, 'w'))
+out.close()
 sys.exit(errors)
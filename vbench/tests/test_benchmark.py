@@ -0,0 +1,240 @@
+import __builtin__
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from nose.tools import eq_, ok_, assert_raises, assert_almost_equal
+
+from vbench.benchmark import (TIMERS, Benchmark, fit_complexity, get_timer,
+                              magic_timeit, measure_memory, median_ci,
+                              profile_diff, relative_precision)
+
+
+def test_median_ci():
+    eq_(median_ci([3., 1., 2.]), (1., 3.))
+    lo, hi = median_ci(range(100))
+    ok_(35 < lo < 50 < hi < 65)
+    ok_(relative_precision(range(100, 200)) < relative_precision(range(100)))
+
+
+def test_magic_timeit_calibration():
+    res = magic_timeit({}, 'pass', repeat=2)
+    eq_(res['repeat'], 2)
+    eq_(len(res['timings']), 2)
+    # each of the calibrated loops takes >= 0.1s of (mostly) CPU time
+    ok_(res['ru_utime'] + res['ru_stime'] > 0.1)
+    ok_(res['ru_minflt'] >= 0)
+    loops, per_call = res['calibration']
+    eq_(loops, res['loops'])
+
+    # earlier calibration is reused as long as it is about right
+    res = magic_timeit({}, 'pass', repeat=2, calibration=(loops, per_call))
+    ok_('calibration' not in res)
+    eq_(res['loops'], loops)
+
+    # but not after time per call moved by orders of magnitude
+    res = magic_timeit({}, 'pass', repeat=2, calibration=(10, 1.))
+    ok_('calibration' in res)
+
+    # a slowdown gets noticed before spending 10000 loops per repeat on it
+    started = time.time()
+    res = magic_timeit({'time': time}, 'time.sleep(0.0005)', repeat=2,
+                       calibration=(10000, 1e-6))
+    ok_(time.time() - started < 3)
+    ok_('calibration' in res)
+    ok_(res['loops'] < 10000)
+
+
+def test_magic_timeit_target_precision():
+    res = magic_timeit({}, 'sum(range(100))', ncalls=10, repeat=3,
+                       target_precision=1e-12, time_budget=0.5)
+    ok_(res['repeat'] > 3)
+    eq_(len(res['timings']), res['repeat'])
+    ok_(res['precision'] is not None)
+
+
+def test_measure_memory():
+    res = measure_memory({}, 'x = [0] * 10000000')
+    # 80MB list on 64bit, 40MB on 32bit -- peak RSS has to grow
+    ok_(res['peak_rss'] > 20 * 2**20)
+    try:
+        import tracemalloc
+    except ImportError:
+        ok_('alloc_peak' not in res)
+    else:
+        ok_(res['alloc_peak'] >= res['alloc_net'] > 20 * 2**20)
+
+
+def test_measure_memory_after_bigger():
+    measure_memory({}, 'x = [0] * 20000000')
+    res = measure_memory({}, 'x = [0] * 10000000')
+    if sys.platform.startswith('linux'):
+        # the peak of the bigger execution was reset in between
+        ok_(res['peak_rss'] > 20 * 2**20)
+
+
+def test_collect():
+    collect = gc.collect
+    collected = []
+
+    def counting_collect(*args):
+        collected.append(args)
+        return collect(*args)
+    gc.collect = counting_collect
+    try:
+        bm = Benchmark('x = 0', '', ncalls=1, repeat=1, name='bm',
+                       memory=True)
+        ok_(bm.run()['succeeded'])
+        eq_(collected, [])
+        # before measuring memory, and before timing
+        ok_(bm.run(collect=True)['succeeded'])
+        eq_(len(collected), 2)
+    finally:
+        gc.collect = collect
+
+
+def test_timers():
+    assert_raises(ValueError, get_timer, 'sundial')
+    for name in TIMERS:
+        timefunc = get_timer(name)
+        start = timefunc()
+        sum(range(100000))
+        ok_(timefunc() >= start)
+        res = magic_timeit({}, 'sum(range(100))', ncalls=10, repeat=2,
+                           timer=name)
+        eq_(res['timer'], name)
+    if sys.platform.startswith('linux'):
+        timefunc = get_timer('perf_counter')
+        start = timefunc()
+        time.sleep(0.01)
+        ok_(0.01 <= timefunc() - start < 1)
+
+
+def test_instances():
+    bm = Benchmark('f(n, k)', 'f = pow', name='pow',
+                   params={'n': [10, 100], 'k': [1, 2]})
+    instances = bm.instances()
+    eq_([b.name for b in instances],
+        ['pow(k=1, n=10)', 'pow(k=1, n=100)',
+         'pow(k=2, n=10)', 'pow(k=2, n=100)'])
+    eq_(instances[1].param, {'k': 1, 'n': 100})
+    eq_(len(set(b.checksum for b in instances)), 4)
+    ok_(all(b.parent == bm.checksum for b in instances))
+    ok_(instances[3].run()['succeeded'])
+
+    plain = Benchmark('pass', '', name='plain')
+    eq_(plain.instances(), [plain])
+
+
+def test_param_results():
+    from vbench.db import BenchmarkDB
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp_dir, 'test.db')
+        db = BenchmarkDB(db_path)
+        bm = Benchmark('[0] * n', '', name='bm', params={'n': [10, 100]})
+        small, large = bm.instances()
+        db.write_benchmark(bm)
+        # the large instance only timed from the second revision on
+        db.write_result(small.checksum, 'r1', datetime(2013, 1, 1), 1, 1.)
+        db.write_result(small.checksum, 'r2', datetime(2013, 1, 2), 1, 2.)
+        db.write_result(large.checksum, 'r2', datetime(2013, 1, 2), 1, 20.)
+        db.write_result(large.checksum, 'r3', datetime(2013, 1, 3), 1, 30.)
+
+        frame = bm.get_param_results(db_path)
+        eq_(list(frame.columns), [10, 100])
+        eq_(len(frame), 3)
+        eq_(list(frame[10].dropna()), [1., 2.])
+        eq_(list(frame[100].dropna()), [20., 30.])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_fit_complexity():
+    sizes = [10, 100, 1000] * 2
+    groups = ['a'] * 3 + ['b'] * 3
+    # quadratic, with a constant factor differing between the groups
+    timings = [1e-6 * n ** 2 for n in sizes[:3]] + \
+              [5e-6 * n ** 2 for n in sizes[3:]]
+    assert_almost_equal(fit_complexity(sizes, timings, groups), 2)
+    assert_almost_equal(fit_complexity([1, 10, 100, 1000],
+                                       [2., 20., None, 2000.]), 1)
+    eq_(fit_complexity([10, 10], [1., 2.]), None)
+
+
+def test_shared_setup():
+    bm = Benchmark('y = x + 1', 'x = 0', ncalls=1, repeat=1, name='bm')
+    other = Benchmark('y = x + 2', 'x = 0', ncalls=1, repeat=1, name='other')
+    eq_(bm.setup_checksum, other.setup_checksum)
+    ok_(bm.checksum != other.checksum)
+
+    ns = bm._setup()
+    ok_(bm.run(ns=ns)['succeeded'])
+    ok_(other.run(ns=ns)['succeeded'])
+    # benchmarks run in copies of the shared namespace
+    ok_('y' not in ns)
+
+
+def test_profile_diff():
+    setup = 'def g(n):\n    return sum(range(n))'
+    fast = Benchmark('g(10)', setup, name='fast').profile(10)
+    slow = Benchmark('g(100000)', setup, name='slow').profile(5)
+    diff = profile_diff((10, fast.stats), (5, slow.stats))
+    # per call times, ranked by the change in cumulative time
+    ok_((diff['cumtime_delta'].abs().diff().dropna() <= 0).all())
+    g = [func for func in diff.index if func.endswith('(g)')]
+    eq_(len(g), 1)
+    eq_(diff.loc[g[0], 'calls_before'], 1)
+    eq_(diff.loc[g[0], 'calls_after'], 1)
+    ok_(diff.loc[g[0], 'cumtime_delta'] > 0)
+
+
+def test_trace_imports():
+    real_import = __builtin__.__import__
+    tmp_dir = tempfile.mkdtemp()
+    sys.path.insert(0, tmp_dir)
+    try:
+        pkg_dir = os.path.join(tmp_dir, 'vb_pkg')
+        os.makedirs(pkg_dir)
+        sources = {'__init__.py': 'ANSWER = 42\n',
+                   'sub.py': 'from . import helper\n'
+                             'def g():\n    return helper.TABLE\n',
+                   'helper.py': 'TABLE = range(10)\n'}
+        for name, source in sources.items():
+            with open(os.path.join(pkg_dir, name), 'w') as f:
+                f.write(source)
+        files = dict((name[:-3], os.path.join(pkg_dir, name))
+                     for name in sources)
+
+        first = Benchmark('g()', 'from vb_pkg.sub import g', name='first')
+        eq_(first.trace() & set(files.values()), set(files.values()))
+
+        # the module level code already ran for the first benchmark
+        later = [Benchmark('g()', 'from vb_pkg.sub import g', name='same'),
+                 Benchmark('vb_pkg.sub.g()', 'import vb_pkg.sub',
+                           name='dotted'),
+                 Benchmark('sub.g()', 'from vb_pkg import sub', name='from'),
+                 Benchmark('def h():\n    import vb_pkg.sub\n'
+                           '    return vb_pkg.sub.g()\nh()', '',
+                           name='in_code')]
+        for bm in later:
+            traced = bm.trace()
+            ok_(files['__init__'] in traced, bm.name)
+            ok_(files['sub'] in traced, bm.name)
+
+        # only what gets imported
+        bm = Benchmark('vb_pkg.ANSWER', 'import vb_pkg', name='package')
+        traced = bm.trace()
+        ok_(files['__init__'] in traced)
+        ok_(files['sub'] not in traced)
+        ok_(__builtin__.__import__ is real_import)
+    finally:
+        sys.path.remove(tmp_dir)
+        for name in list(sys.modules):
+            if name == 'vb_pkg' or name.startswith('vb_pkg.'):
+                del sys.modules[name]
+        shutil.rmtree(tmp_dir)
@@ -1,4 +1,14 @@
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import datetime
+
+import numpy as np
+from nose.tools import eq_, ok_
+
+from vbench.benchmark import Benchmark
+from vbench.db import BenchmarkDB
 
 # from gitbench.db import BenchmarkDB  # FIXME: test is actually empty
 
@@ -16,6 +26,51 @@ class TestBenchmarkDB(unittest.TestCase):
         pass
 
 
+def test_normalized_results():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db = BenchmarkDB(os.path.join(tmp_dir, 'test.db'))
+        bm = Benchmark('pass', '', name='bm')
+        db.write_benchmark(bm)
+        # machine running at half speed for the second revision
+        for day, timing, reference in [(1, 10., 1.), (2, 20., 2.),
+                                       (3, 30., None)]:
+            db.write_result(bm.checksum, 'r%d' % day, datetime(2013, 1, day),
+                            1, timing, extra={'reference': reference})
+        eq_(db.get_reference_scale(), 1.5)
+
+        results = db.get_benchmark_results(bm.checksum, normalize=True)
+        eq_(list(results['timing'][:2]), [15., 15.])
+        ok_(np.isnan(results['timing'][2]))
+        eq_(list(db.get_benchmark_results(bm.checksum)['timing']),
+            [10., 20., 30.])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_benchmark_files():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db = BenchmarkDB(os.path.join(tmp_dir, 'test.db'))
+        bm = Benchmark('pass', '', name='bm')
+        other = Benchmark('1', '', name='other')
+        db.write_benchmark(bm)
+        db.write_benchmark(other)
+        eq_(db.get_benchmark_files(), {})
+
+        db.write_benchmark_files(bm.checksum, ['a.py', 'b.py'], 'r1')
+        # traced, but executing none of the files: still recorded
+        db.write_benchmark_files(other.checksum, [], 'r1')
+        eq_(db.get_benchmark_files(), {bm.checksum: set(['a.py', 'b.py']),
+                                       other.checksum: set()})
+
+        db.write_benchmark_files(bm.checksum, [], 'r2')
+        eq_(db.get_benchmark_files(), {bm.checksum: set(),
+                                       other.checksum: set()})
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=[__file__, '-vvs', '-x', '--pdb', '--pdb-failure'],
@@ -0,0 +1,285 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from nose.tools import eq_, ok_
+
+from vbench.git import BenchRepo, ChurnIndex, GitRepo
+
+
+def _git(repo_path, *args, **kwargs):
+    env = dict(os.environ, GIT_AUTHOR_NAME='vb', GIT_AUTHOR_EMAIL='vb@x',
+               GIT_COMMITTER_NAME='vb', GIT_COMMITTER_EMAIL='vb@x')
+    # distinct timestamps, as GitRepo drops commits with duplicate ones
+    if 'day' in kwargs:
+        env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = \
+            '2013-01-%02d 12:00:00 +0000' % kwargs['day']
+    return subprocess.check_output(['git'] + list(args), cwd=repo_path,
+                                   env=env).strip()
+
+
+def _commit(repo_path, day, content, amend=False, path='mod.py'):
+    """
+    Commit content to path, or (if content is a dict) contents by path
+    """
+    if not isinstance(content, dict):
+        content = {path: content}
+    for path, text in content.iteritems():
+        with open(os.path.join(repo_path, path), 'w') as f:
+            f.write(text)
+        _git(repo_path, 'add', path)
+    _git(repo_path, 'commit', '-q', '-m', 'day %d' % day,
+         *(['--amend'] if amend else []), day=day)
+    return _git(repo_path, 'rev-parse', '--short', 'HEAD')
+
+
+class _Recorder(object):
+    """
+    Records the revisions a (revisions reading) method of GitRepo gets
+    called for, until stopped
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+        self._method = getattr(GitRepo, name)
+
+        def recording(repo, revisions):
+            self.calls.append(revisions)
+            return self._method(repo, revisions)
+        setattr(GitRepo, name, recording)
+
+    def stop(self):
+        setattr(GitRepo, self.name, self._method)
+
+
+def _churn(repo):
+    churn = repo.get_churn_by_file()
+    return sorted(tuple(row) for row in churn.values.tolist())
+
+
+def _make_repo(tmp_dir):
+    repo_path = os.path.join(tmp_dir, 'repo')
+    os.makedirs(repo_path)
+    _git(repo_path, 'init', '-q')
+    _commit(repo_path, 1, 'a\n')
+    _commit(repo_path, 2, 'a\nb\nc\n')
+    return repo_path
+
+
+def test_churn_index_interrupted_append():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'churn')
+        index = ChurnIndex(path)
+        index.append('t1', [('s1', datetime(2013, 1, 1), [('a.py', 1, 0)]),
+                            ('s2', datetime(2013, 1, 2), [('a.py', 2, 1),
+                                                          ('b.py', 3, 0)])])
+        # an append which wrote columns, but died before the metadata
+        for name in ChurnIndex._columns:
+            with open(index._column_path(name), 'ab') as f:
+                np.array([99, 99], dtype=np.int32).tofile(f)
+
+        index = ChurnIndex(path)
+        eq_(index.tip, 't1')
+        eq_(list(index.column('insertions')), [1, 2, 3])
+        index.append('t2', [('s3', datetime(2013, 1, 3), [('b.py', 4, 5)])])
+
+        index = ChurnIndex(path)
+        eq_(index.tip, 't2')
+        eq_(index.shas, ['s1', 's2', 's3'])
+        eq_(index.paths, ['a.py', 'b.py'])
+        eq_(list(index.column('commit')), [0, 1, 1, 2])
+        eq_(list(index.column('path')), [0, 0, 1, 1])
+        eq_(list(index.column('insertions')), [1, 2, 3, 4])
+        eq_(list(index.column('deletions')), [0, 1, 0, 5])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_churn_index_incremental():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = _make_repo(tmp_dir)
+        index_path = os.path.join(tmp_dir, 'churn')
+        repo = GitRepo(repo_path, churn_index_path=index_path)
+        tip = repo._rev_parse('HEAD')
+        eq_(_churn(repo), [(repo.shas[-1], 'mod.py', 2, 0)])
+
+        new = _commit(repo_path, 3, 'a\nc\nd\ne\n')
+        numstat = _Recorder('_read_numstat')
+        try:
+            repo = GitRepo(repo_path, churn_index_path=index_path)
+            churn = _churn(repo)
+            # only the new commit got read
+            eq_(numstat.calls, ['%s..%s' % (tip, repo._rev_parse('HEAD'))])
+
+            # up to date: nothing to read
+            del numstat.calls[:]
+            eq_(_churn(GitRepo(repo_path, churn_index_path=index_path)),
+                churn)
+            eq_(numstat.calls, [])
+        finally:
+            numstat.stop()
+        eq_(churn, _churn(GitRepo(repo_path)))
+        ok_((new, 'mod.py', 2, 1) in churn)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_churn_index_rewritten_history():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = _make_repo(tmp_dir)
+        index_path = os.path.join(tmp_dir, 'churn')
+        old = GitRepo(repo_path, churn_index_path=index_path).shas[-1]
+        _churn(GitRepo(repo_path, churn_index_path=index_path))
+
+        # the indexed tip is no longer part of the history
+        new = _commit(repo_path, 2, 'a\nx\n', amend=True)
+        repo = GitRepo(repo_path, churn_index_path=index_path)
+        churn = _churn(repo)
+        eq_(churn, _churn(GitRepo(repo_path)))
+        eq_(churn, [(new, 'mod.py', 1, 0)])
+        ok_(old not in ChurnIndex(index_path).shas)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_history_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = _make_repo(tmp_dir)
+        cache_path = os.path.join(tmp_dir, 'history.pickle')
+        repo = GitRepo(repo_path, cache_path=cache_path)
+        eq_(len(repo.shas), 2)
+        tip = repo._rev_parse('HEAD')
+
+        # new commits are parsed on top of the cached history
+        _commit(repo_path, 3, 'a\nd\n')
+        _commit(repo_path, 4, 'a\ne\n')
+        commit_log = _Recorder('_read_commit_log')
+        try:
+            repo = GitRepo(repo_path, cache_path=cache_path)
+            eq_(commit_log.calls,
+                ['%s..%s' % (tip, repo._rev_parse('HEAD'))])
+            eq_(list(repo.messages), ['day 1', 'day 2', 'day 3', 'day 4'])
+            shas = list(repo.shas)
+
+            # cache at HEAD: nothing to parse
+            del commit_log.calls[:]
+            eq_(list(GitRepo(repo_path, cache_path=cache_path).shas), shas)
+            eq_(commit_log.calls, [])
+
+            # rewritten history is parsed from scratch
+            _commit(repo_path, 4, 'a\nf\n', amend=True)
+            del commit_log.calls[:]
+            repo = GitRepo(repo_path, cache_path=cache_path)
+            eq_(commit_log.calls[-1], repo._rev_parse('HEAD'))
+        finally:
+            commit_log.stop()
+        eq_(shas[:3], list(repo.shas)[:3])
+        ok_(shas[3] != repo.shas[3])
+        eq_(list(repo.shas), list(GitRepo(repo_path).shas))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_build_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = os.path.join(tmp_dir, 'repo')
+        os.makedirs(repo_path)
+        _git(repo_path, 'init', '-q')
+        build = 'cp ext.src _ext.so\n'
+        revs = [_commit(repo_path, 1, {'build.sh': build, 'ext.src': 'one'}),
+                # a broken build leaves the previous _ext.so behind
+                _commit(repo_path, 2, {'build.sh': 'exit 1\n'}),
+                _commit(repo_path, 3, {'build.sh': build, 'ext.src': 'two'}),
+                _commit(repo_path, 4, {'ext.src': 'one'})]
+
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        target_dir = os.path.join(tmp_dir, 'target')
+        bench_repo = BenchRepo(repo_path, target_dir, 'sh build.sh', '',
+                               build_cache_dir=cache_dir,
+                               build_cache_paths=['build.sh', 'ext.src'])
+        builds = []
+        build_method = bench_repo._build
+
+        def recording_build():
+            builds.append(bench_repo.current_rev)
+            return build_method()
+        bench_repo._build = recording_build
+
+        def built():
+            return open(os.path.join(target_dir, '_ext.so')).read()
+
+        bench_repo.switch_to_revision(revs[0])
+        eq_(built(), 'one')
+        eq_(len(os.listdir(cache_dir)), 1)
+
+        bench_repo.switch_to_revision(revs[1])
+        eq_(len(builds), 2)
+        # the failed build got nothing cached
+        eq_(len(os.listdir(cache_dir)), 1)
+
+        bench_repo.switch_to_revision(revs[2])
+        eq_(built(), 'two')
+        eq_(len(os.listdir(cache_dir)), 2)
+
+        # same build inputs as the first revision: restored, not built
+        bench_repo.switch_to_revision(revs[3])
+        eq_(len(builds), 3)
+        eq_(built(), 'one')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_worktree_checkouts():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = os.path.join(tmp_dir, 'repo')
+        os.makedirs(repo_path)
+        _git(repo_path, 'init', '-q')
+        revs = [_commit(repo_path, 1, {'build.sh': 'cp ext.src _ext.so\n',
+                                       'ext.src': 'one'}),
+                # no longer builds _ext.so
+                _commit(repo_path, 2, {'build.sh': 'true\n',
+                                       'ext.src': 'two'}),
+                _commit(repo_path, 3, {'ext.src': 'three'})]
+
+        clone_dir = os.path.join(tmp_dir, 'clone')
+        target_dir = os.path.join(tmp_dir, 'target')
+        bench_repo = BenchRepo(repo_path, target_dir, 'sh build.sh', '',
+                               always_clean=True, use_worktree=True,
+                               clone_dir=clone_dir)
+        # a worktree of the clone, not a clone of its own
+        ok_(os.path.isfile(os.path.join(target_dir, '.git')))
+
+        def read(path):
+            return open(os.path.join(target_dir, path)).read()
+
+        bench_repo.switch_to_revision(revs[0])
+        eq_(read('_ext.so'), 'one')
+        for rev, content in zip(revs[1:], ['two', 'three']):
+            bench_repo.switch_to_revision(rev)
+            eq_(_git(target_dir, 'rev-parse', '--short', 'HEAD'), rev)
+            eq_(read('ext.src'), content)
+            # untracked build products of the first revision got cleaned
+            ok_(not os.path.exists(os.path.join(target_dir, '_ext.so')))
+            ok_(os.path.exists(os.path.join(target_dir,
+                                            'vb_run_benchmarks.py')))
+
+        # a second worktree sharing the clone
+        other_dir = os.path.join(tmp_dir, 'other')
+        other = BenchRepo(repo_path, other_dir, 'sh build.sh', '',
+                          use_worktree=True, clone_dir=clone_dir)
+        other.switch_to_revision(revs[0])
+        eq_(open(os.path.join(other_dir, '_ext.so')).read(), 'one')
+        eq_(read('ext.src'), 'three')
+    finally:
+        shutil.rmtree(tmp_dir)
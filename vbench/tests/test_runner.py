@@ -0,0 +1,322 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from nose.tools import assert_raises, eq_, ok_
+from pandas import Series
+
+from vbench.benchmark import Benchmark
+from vbench.runner import BenchmarkRunner
+from vbench.tests.test_git import _commit, _git
+
+# setup for benchmarks of the repositories made by _Sandbox.make_runner
+SETUP = "import sys; sys.path.insert(0, '.'); from mod import f"
+
+
+class _Sandbox(object):
+    """
+    Temporary directory, with the benchmark processes (which run `python`
+    found on PATH) made to run this python and vbench
+    """
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.path, 'bin')
+        os.makedirs(bin_dir)
+        os.symlink(sys.executable, os.path.join(bin_dir, 'python'))
+        self._environ = os.environ.copy()
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return self
+
+    def __exit__(self, *exc_info):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.path)
+
+    def make_runner(self, benchmarks, commits=1, **kwargs):
+        """
+        BenchmarkRunner for a new repository of commits revisions (a day
+        apart) of mod.py defining f
+        """
+        repo_path = os.path.join(self.path, 'repo')
+        if not os.path.exists(repo_path):
+            os.makedirs(repo_path)
+            _git(repo_path, 'init', '-q')
+            for day in range(1, commits + 1):
+                _commit(repo_path, day,
+                        'def f(n):\n    return sum(range(n * %d))\n' % day)
+        kwargs.setdefault('run_option', 'all')
+        return BenchmarkRunner(benchmarks, repo_path, repo_path, 'true',
+                               os.path.join(self.path, 'db.sqlite'),
+                               os.path.join(self.path, 'tmp'), 'true',
+                               **kwargs)
+
+
+class _History(object):
+    """Stands in for GitRepo, with revisions one day apart"""
+
+    def __init__(self, revs):
+        start = datetime(2013, 1, 1)
+        self.shas = Series(revs, [start + timedelta(days=i)
+                                  for i in range(len(revs))])
+
+
+class _Checkout(object):
+    """
+    Stands in for BenchRepo, recording its checkouts (and builds) into
+    events and flagging the revisions as built
+    """
+
+    def __init__(self, target_dir, events, built):
+        self.target_dir = target_dir
+        self.current_rev = None
+        self._events = events
+        self._built = built
+
+    def switch_to_revision(self, rev):
+        self._events.append(('build', self.target_dir, rev))
+        self.current_rev = rev
+        self._built[rev].set()
+
+
+def test_bisect_noise():
+    revs = ['r%02d' % i for i in range(40)]
+    benchmarks = [Benchmark('%d' % i, '', name='bm%d' % i)
+                  for i in range(20)]
+    rng = np.random.RandomState(0)
+    timings = {}
+    for i, rev in enumerate(revs):
+        # 1% noise everywhere, and the first benchmark 2x slower from r23 on
+        timings[rev] = dict((bm.checksum, 1 + 0.01 * rng.randn())
+                            for bm in benchmarks)
+        if i >= 23:
+            timings[rev][benchmarks[0].checksum] *= 2
+
+    runner = BenchmarkRunner.__new__(BenchmarkRunner)
+    runner.repo = _History(revs)
+    runner._instances = benchmarks
+    runner._get_rev_timings = lambda rev, benchmarks: timings[rev]
+
+    eq_(runner.bisect('r00', 'r39'), ('r22', 'r23'))
+    eq_(runner.bisect('r00', 'r39', benchmarks=benchmarks[:1]),
+        ('r22', 'r23'))
+
+
+def test_memory_benchmarks_isolated():
+    # leaves plenty of freed (but fragmented, so not returned) heap behind
+    # for the next benchmark to reuse
+    big = Benchmark('x = ["%d" % i for i in xrange(400000)]; '
+                    'sys.modules["mod"].keep = x[::100]',
+                    SETUP, ncalls=1, repeat=1, name='big', memory=True)
+    small = Benchmark('x = [str(i) for i in xrange(100000)]', SETUP,
+                      ncalls=1, repeat=1, name='small', memory=True)
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner([big, small])
+        runner.run()
+        results = runner.db.get_benchmark_results(small.checksum,
+                                                  extra=['peak_rss'])
+        eq_(len(results), 1)
+        ok_(results['traceback'][0] is None)
+        # 100000 strings of about 40 bytes each, plus the list
+        ok_(results['peak_rss'][0] > 3 * 2**20)
+
+
+def test_timer_validation():
+    bm = Benchmark('pass', '', name='bm')
+    sundial = Benchmark('pass', '', name='sundial', timer='sundial')
+    with _Sandbox() as sandbox:
+        assert_raises(ValueError, sandbox.make_runner, [bm], timer='sundial')
+        assert_raises(ValueError, sandbox.make_runner, [bm, sundial])
+        sandbox.make_runner([bm], timer='process')
+
+
+def test_process_dies_between_benchmarks():
+    benchmarks = [Benchmark('x = %d' % i, '', name='bm%d' % i)
+                  for i in range(3)]
+    crash = {'succeeded': False, 'stage': 'crash', 'traceback': 'died'}
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner(benchmarks, commits=2)
+        rev = runner.repo.shas[-1]
+        batches = []
+
+        def run_benchmarks(rev, bench_repo, batch, cpus, results, trace):
+            batches.append([bm.name for bm in batch])
+            if len(batches) == 1:
+                # bm0 reported back, then the process died before bm1
+                results[batch[0].checksum] = {'succeeded': True,
+                                              'timing': 1., 'loops': 1}
+                return batch[0].checksum, crash
+            # later processes die inside the first benchmark they start
+            return batch[0].checksum, crash
+        runner._run_benchmarks = run_benchmarks
+
+        n_active, results = runner._run_revision(rev)
+        eq_(n_active, 3)
+        eq_(batches, [['bm0', 'bm1', 'bm2'], ['bm1', 'bm2'], ['bm2']])
+        # the success of bm0 is kept
+        eq_(results[benchmarks[0].checksum]['timing'], 1.)
+        eq_(results[benchmarks[1].checksum]['stage'], 'crash')
+        eq_(results[benchmarks[2].checksum]['stage'], 'crash')
+
+        # no progress at all: given up on
+        del batches[:]
+        runner._run_benchmarks = lambda *args: batches.append(args) or \
+            (None, crash)
+        eq_(runner._run_revision(runner.repo.shas[0]), (3, {}))
+        eq_(len(batches), 1)
+
+
+def test_parallel_workers():
+    bm = Benchmark('f(100)', SETUP, ncalls=10, repeat=2, name='f')
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner([bm], commits=4, n_workers=2)
+        revisions = list(runner.repo.shas)
+        ran = runner.run()
+        # in the order of the revisions, whichever worker finished first
+        eq_([rev for rev, res in ran], revisions)
+        ok_(all(res == (True, 1) for rev, res in ran))
+        results = runner.db.get_benchmark_results(bm.checksum)
+        eq_(sorted(results['revision']), sorted(revisions))
+        ok_(results['traceback'].isnull().all())
+        ok_(results['timing'].notnull().all())
+
+
+def test_pipelined():
+    bm = Benchmark('f(100)', SETUP, name='f')
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner([bm], commits=3, prefetch=True,
+                                     build_cpus=[0])
+        eq_([bench_repo.build_cpus for bench_repo in runner.bench_repos],
+            [[0], [0]])
+
+        revisions = list(runner.repo.shas)
+        events = []
+        built = dict((rev, threading.Event()) for rev in revisions)
+        runner.bench_repos = [_Checkout(name, events, built)
+                              for name in ('w0', 'w1')]
+
+        def run_rev(rev, bench_repo, cpus=None):
+            if bench_repo.current_rev != rev:
+                bench_repo.switch_to_revision(rev)
+            events.append(('run', bench_repo.target_dir, rev))
+            i = revisions.index(rev)
+            if i + 1 < len(revisions):
+                # gets prefetched meanwhile, rather than after this run
+                ok_(built[revisions[i + 1]].wait(10))
+            events.append(('done', bench_repo.target_dir, rev))
+            return True, 1
+        runner._run_rev = run_rev
+
+        ran = runner.run()
+        eq_([rev for rev, res in ran], revisions)
+        # alternating between the checkouts, each revision built once
+        checkouts = ['w0', 'w1', 'w0']
+        eq_([event[1:] for event in events if event[0] == 'run'],
+            zip(checkouts, revisions))
+        eq_(sorted(event[1:] for event in events if event[0] == 'build'),
+            sorted(zip(checkouts, revisions)))
+        for i in range(len(revisions) - 1):
+            ok_(events.index(('build', checkouts[i + 1], revisions[i + 1]))
+                < events.index(('done', checkouts[i], revisions[i])))
+
+
+def test_timeout():
+    sleeper = Benchmark('time.sleep(60)', SETUP + '; import time', ncalls=1,
+                        repeat=1, name='sleeper')
+    quick = Benchmark('f(10)', SETUP, ncalls=1, repeat=1, name='quick')
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner([sleeper, quick], timeout=3)
+        runner.run()
+        results = runner.db.get_benchmark_results(sleeper.checksum)
+        eq_(list(results['stage']), ['timeout'])
+        ok_(results['timing'].isnull().all())
+        # the benchmark after it got run by a new process
+        results = runner.db.get_benchmark_results(quick.checksum)
+        ok_(results['traceback'][0] is None)
+        ok_(results['timing'][0] > 0)
+
+
+def test_memory_limit():
+    # allocates from C without checking for failure, so the process
+    # segfaults once malloc gives up
+    crasher = Benchmark('ctypes.memset(libc.malloc(2 ** 31), 0, 2 ** 31)',
+                        SETUP + '; import ctypes, ctypes.util; '
+                        'libc = ctypes.CDLL(ctypes.util.find_library("c")); '
+                        'libc.malloc.restype = ctypes.c_void_p',
+                        ncalls=1, repeat=1, name='crasher')
+    hog = Benchmark('x = [0] * 2 ** 30', SETUP, ncalls=1, repeat=1,
+                    name='hog')
+    quick = Benchmark('f(10)', SETUP, ncalls=1, repeat=1, name='quick')
+    with _Sandbox() as sandbox:
+        runner = sandbox.make_runner([crasher, hog, quick], isolate=True,
+                                     memory_limit=600 * 2**20)
+        runner.run()
+
+        def stages(bm):
+            return list(runner.db.get_benchmark_results(bm.checksum)['stage'])
+        eq_(stages(crasher), ['crash'])
+        # got a MemoryError rather than 8GB
+        eq_(stages(hog), ['benchmark'])
+        eq_(stages(quick), [None])
+
+
+def _make_docs_repo(repo_path):
+    """
+    Repository in which only every other commit changes mod.py
+    """
+    os.makedirs(repo_path)
+    _git(repo_path, 'init', '-q')
+    code = 'def f(n):\n    return sum(range(n * %d))\n'
+    return [_commit(repo_path, 1, {'mod.py': code % 1, 'README': 'a'}),
+            _commit(repo_path, 2, {'README': 'b'}),
+            _commit(repo_path, 3, {'mod.py': code % 3}),
+            _commit(repo_path, 4, {'README': 'c', 'doc.txt': 'd'})]
+
+
+def test_path_filtering():
+    bm = Benchmark('f(100)', SETUP, name='f')
+    with _Sandbox() as sandbox:
+        revs = _make_docs_repo(os.path.join(sandbox.path, 'repo'))
+
+        def revisions(**kwargs):
+            runner = sandbox.make_runner([bm], **kwargs)
+            return [rev[:len(revs[0])]
+                    for rev in runner._get_revisions_to_run()]
+        eq_(revisions(), revs)
+        eq_(revisions(include_paths=['*.py']), [revs[0], revs[2]])
+        eq_(revisions(exclude_paths=['README']),
+            [revs[0], revs[2], revs[3]])
+        eq_(revisions(exclude_paths=['README', 'doc*']), [revs[0], revs[2]])
+
+
+def test_inherited_results():
+    bm = Benchmark('f(100)', SETUP, ncalls=10, repeat=2, name='f')
+    with _Sandbox() as sandbox:
+        _make_docs_repo(os.path.join(sandbox.path, 'repo'))
+        runner = sandbox.make_runner([bm], include_paths=['*.py'],
+                                     inherit_results=True)
+        revs = list(runner.repo.shas)
+        run_revision = runner._run_revision
+        inherited = {}
+
+        def recording_run_revision(rev, *args, **kwargs):
+            # what got inherited by the time the next revision runs
+            inherited[rev] = runner.db.get_rev_results(revs[1]).keys()
+            return run_revision(rev, *args, **kwargs)
+        runner._run_revision = recording_run_revision
+
+        eq_([rev for rev, res in runner.run()], [revs[0], revs[2]])
+        eq_(inherited, {revs[0]: [], revs[2]: [bm.checksum]})
+
+        results = runner.db.get_benchmark_results(bm.checksum)
+        results = results.set_index('revision')
+        eq_(list(results['inherited_from'].reindex(revs)),
+            [None, revs[0], None, revs[2]])
+        eq_(results['timing'][revs[1]], results['timing'][revs[0]])
+        eq_(results['timing'][revs[3]], results['timing'][revs[2]])
@@ -0,0 +1,26 @@
+from nose.tools import eq_, ok_
+
+from vbench.sampling import (sample, format_collapsed, parse_collapsed,
+                             diff_collapsed)
+
+
+def test_sample():
+    ns = {}
+    exec 'def spin(n):\n    while n:\n        n -= 1' in ns
+    stacks = sample(ns, 'spin(100000)', duration=0.3)
+    ok_(sum(stacks.values()) > 10)
+    for stack in stacks:
+        ok_(stack.startswith('<module> (<f>:1)'))
+    ok_(any(stack.endswith(';spin (<string>:1)') for stack in stacks))
+
+
+def test_collapsed():
+    stacks = {'a (x.py:1);b (x.py:5)': 3, 'a (x.py:1)': 1}
+    text = format_collapsed(stacks)
+    eq_(text, 'a (x.py:1) 1\na (x.py:1);b (x.py:5) 3\n')
+    eq_(parse_collapsed(text), stacks)
+
+    eq_(diff_collapsed({'a': 1, 'a;b': 1}, {'a;b': 4}),
+        'a 2 0\na;b 2 4\n')
+    eq_(diff_collapsed({'a': 1, 'a;b': 1}, {'a;b': 4}, normalize=False),
+        'a 1 0\na;b 1 4\n')
@@ -31,7 +31,7 @@ __license__ = 'MIT'
 
 from nose.tools import eq_, ok_
 
-from vbench.utils import multires_order
+from vbench.utils import multires_order, discrepancy_next
 
 def test_multires_order():
     r = [str(x) for x in range(5)]
@@ -52,3 +52,62 @@ def test_multires_order():
         if n > 2: eq_(o[2], n-1)
         if n > 8: ok_(o[3] != 1)          # we must not get to the 1st yet
         if n > 3: ok_(o[-1] in [n-2, n-3])   # end should be very close to last ones
+
+def test_taskset_cmd():
+    from vbench.utils import taskset_cmd
+    eq_(taskset_cmd('make', None), 'make')
+    eq_(taskset_cmd('make', []), 'make')
+    eq_(taskset_cmd('make; make install', [2, 3]),
+        "taskset -c 2,3 sh -c 'make; make install'")
+
+def test_discrepancy_next():
+    import numpy as np
+    eq_(discrepancy_next([], []), None)
+    eq_(discrepancy_next([1., 1., 1.], [False, True, True]), 0)
+    eq_(discrepancy_next([1., 1., 1.], [True, True, False]), 2)
+    eq_(discrepancy_next([1., 1., 1.], [True, True, True]), None)
+
+    # noisy timings with a step between 60 and 61
+    n = 101
+    rng = np.random.RandomState(0)
+    timings = np.where(np.arange(n) > 60, 2., 1.) + rng.uniform(0, .05, n)
+    measured = np.zeros(n, dtype=bool)
+    measured[[0, 25, 50, 75, 100]] = True
+    # the discrepant gap gets refined first, not the wider flat ones
+    eq_(discrepancy_next(timings, measured), 62)
+    for _ in range(5):
+        measured[discrepancy_next(timings, measured)] = True
+    ok_(measured[60] and measured[61])
+
+    # failed (NaN) measurements do not count as discrepancies
+    timings[61] = np.nan
+    measured[:] = False
+    measured[[0, 50, 61, 100]] = True
+    eq_(discrepancy_next(timings, measured), 25)
+
+def test_get_run_settings():
+    import sys
+    from vbench.utils import get_run_settings
+    settings = get_run_settings()
+    eq_(settings['python'], sys.version.split()[0])
+    ok_('nice' in settings and 'cpus' in settings)
+
+def test_select_by_coverage():
+    from vbench.benchmark import Benchmark
+    from vbench.utils import select_by_coverage
+    uses_a = Benchmark('a()', '', name='uses_a')
+    uses_b = Benchmark('b()', '', name='uses_b')
+    untraced = Benchmark('c()', '', name='untraced')
+    # traced, but executes none of the repository's files
+    no_files = Benchmark('1', '', name='no_files')
+    benchmarks = [uses_a, uses_b, untraced, no_files]
+    coverage = {uses_a.checksum: set(['a.py', 'common.py']),
+                uses_b.checksum: set(['b.py', 'common.py']),
+                no_files.checksum: set()}
+
+    eq_(select_by_coverage(benchmarks, coverage, ['a.py']),
+        [uses_a, untraced])
+    eq_(select_by_coverage(benchmarks, coverage, ['common.py', 'doc.rst']),
+        [uses_a, uses_b, untraced])
+    eq_(select_by_coverage(benchmarks, coverage, ['doc.rst']), [untraced])
+    eq_(select_by_coverage(benchmarks, {}, []), benchmarks)
@@ -32,7 +32,8 @@ __license__ = 'MIT'
 from itertools import chain
 from math import ceil
 
-import importlib, sys, subprocess
+import importlib, os, sys, subprocess, pipes
+from fnmatch import fnmatch
 
 from vbench.benchmark import Benchmark
 
@@ -89,6 +90,57 @@ def multires_order(n):
     assert(set(out) == set(range(n)))
     return out
 
+def discrepancy_next(timings, measured):
+    """Choose index to measure next so that step changes get located first
+
+    Gaps of unmeasured indexes between measured neighbours get ranked by
+    how much timings of the neighbours differ relative to noise (median
+    absolute difference between consecutive measured timings of each
+    benchmark), summed across benchmarks.  Wider gaps win ties, so flat
+    stretches still get refined eventually.  Returns the middle of the
+    top ranked gap, or None if every index is measured.
+
+    timings : array (n, m)
+      timings of m benchmarks at n indexes, NaN where not available
+    measured : array (n,) of bool
+      which indexes were already measured (possibly unsuccessfully)
+    """
+    import numpy as np
+
+    timings = np.asarray(timings, dtype=float)
+    if timings.ndim == 1:
+        timings = timings[:, None]
+    n = len(measured)
+    idx = np.flatnonzero(measured)
+
+    # first and last are the anchors
+    if not len(idx) or idx[0] > 0:
+        return 0 if n else None
+    if idx[-1] < n - 1:
+        return n - 1
+
+    noise = np.ones(timings.shape[1])
+    for k in xrange(timings.shape[1]):
+        col = timings[idx, k]
+        col = col[~np.isnan(col)]
+        if len(col) > 1:
+            noise[k] = np.median(np.abs(np.diff(col)))
+        if not noise[k] > 0 and len(col):
+            # no spread yet -- fall back to 1% of the timings
+            noise[k] = 0.01 * np.median(np.abs(col))
+        if not noise[k] > 0:
+            noise[k] = 1.
+
+    best, best_key = None, None
+    for left, right in zip(idx[:-1], idx[1:]):
+        if right - left < 2:
+            continue
+        score = np.nansum(np.abs(timings[right] - timings[left]) / noise)
+        key = (score, right - left)
+        if best_key is None or key > best_key:
+            best, best_key = (left + right) // 2, key
+    return best
+
 def run_cmd(cmd, stderr_levels=('warn', 'error'), **kwargs):
     """Helper function to unify invocation and logging of external commands
 
@@ -97,6 +149,9 @@ def run_cmd(cmd, stderr_levels=('warn', 'error'), **kwargs):
     """
 
     log.debug(cmd if isinstance(cmd, basestring) else ' '.join(cmd))
+    # commands get run from concurrent worker threads: keep children from
+    # inheriting the pipes of each other, which would keep them open
+    kwargs.setdefault('close_fds', True)
     proc = subprocess.Popen(cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -109,6 +164,65 @@ def run_cmd(cmd, stderr_levels=('warn', 'error'), **kwargs):
             getattr(log, stderr_level)("stderr: " + stderr)
     return proc
 
+def taskset_cmd(cmd, cpus):
+    """Wrap shell command `cmd` so it (and its children) run on `cpus` only
+
+    Relies on taskset(1) from util-linux.  If cpus is empty or None,
+    cmd is returned as is.
+    """
+    if not cpus:
+        return cmd
+    return 'taskset -c %s sh -c %s' % (','.join(map(str, cpus)),
+                                       pipes.quote(cmd))
+
+def matches_any(path, patterns):
+    """Return True if path matches any of the glob patterns"""
+    return any(fnmatch(path, pattern) for pattern in patterns)
+
+def select_by_coverage(benchmarks, coverage, changed):
+    """
+    Benchmarks which were not traced yet (not in coverage, dict of sets of
+    files by checksum) or executed any of the changed files
+    """
+    changed = set(changed)
+    return [bm for bm in benchmarks
+            if bm.checksum not in coverage
+            or coverage[bm.checksum] & changed]
+
+# environment variables limiting the number of threads of OpenMP and the
+# usual BLAS implementations and numexpr
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS')
+
+def get_allowed_cpus():
+    """CPUs this process may run on, as a taskset-style list, or None"""
+    if hasattr(os, 'sched_getaffinity'):
+        return ','.join(map(str, sorted(os.sched_getaffinity(0))))
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return None
+
+def get_run_settings():
+    """
+    Conditions benchmarks are run under in this process: allowed CPUs,
+    niceness, PYTHONHASHSEED, thread limits (THREAD_ENV_VARS) and python
+    version
+    """
+    settings = {'cpus': get_allowed_cpus(),
+                'nice': os.nice(0) if hasattr(os, 'nice') else None,
+                'hash_seed': os.environ.get('PYTHONHASHSEED'),
+                'python': sys.version.split()[0]}
+    for var in THREAD_ENV_VARS:
+        if var in os.environ:
+            settings[var] = os.environ[var]
+    return settings
+
 # TODO: join two together
 def collect_benchmarks_from_object(obj):
     if isinstance(obj, Benchmark):